@@ -0,0 +1,71 @@
+"""Measure the throughput of the Atari preprocessing wrappers on the CPU. Compares the separate
+`MaxAndRepeatEnv` and `WarpFrame` wrappers with the fused `MaxAndWarpFrame` wrapper.
+
+Usage:
+```bash
+python3 -m examples.bench_atari_preprocessing --env-id=PongNoFrameskip-v4 --steps=20000
+```
+"""
+
+import argparse
+import time
+
+import gym
+import numpy as np
+
+from rltf.envs.atari import MaxAndRepeatEnv
+from rltf.envs.atari import MaxAndWarpFrame
+from rltf.envs.atari import StackFrames
+from rltf.envs.atari import WarpFrame
+
+
+def wrap_separate(env):
+    env = MaxAndRepeatEnv(env, repeat=4)
+    env = WarpFrame(env)
+    return StackFrames(env, k=4)
+
+
+def wrap_fused(env):
+    env = MaxAndWarpFrame(env, repeat=4)
+    return StackFrames(env, k=4)
+
+
+def run(env_id, wrap, steps, seed):
+    """Step the wrapped env with random actions
+    Returns:
+        float. Number of emulator frames per second
+    """
+    env = wrap(gym.make(env_id))
+    env.seed(seed)
+    prng = np.random.RandomState(seed)
+    actions = prng.randint(0, env.action_space.n, size=steps)
+
+    env.reset()
+    start = time.time()
+    for action in actions:
+        _, _, done, _ = env.step(action)
+        if done:
+            env.reset()
+    duration = time.time() - start
+    env.close()
+
+    # Every agent step is 4 emulator frames
+    return 4 * steps / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env-id", default="PongNoFrameskip-v4", type=str, help="Atari env id")
+    parser.add_argument("--steps",  default=20000,                type=int, help="Agent steps per run")
+    parser.add_argument("--seed",   default=0,                    type=int, help="Random seed")
+    args = parser.parse_args()
+
+    assert 'NoFrameskip' in args.env_id
+
+    for name, wrap in [("separate", wrap_separate), ("fused", wrap_fused)]:
+        fps = run(args.env_id, wrap, args.steps, args.seed)
+        print("{:<10} {:>10.1f} frames/sec".format(name, fps))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 import json
 import logging
+import multiprocessing
 import os
 import re
 import signal
+import threading
+import traceback
 import numpy as np
 import tensorflow as tf
 
+from gym.utils  import atomic_write
 from rltf.utils import seeding
 
 
@@ -20,6 +24,8 @@ class Agent:
                eval_len,
                model_dir,
                save_period=1000000,
+               async_save=False,
+               eval_worker=False,
                n_plays=0,
                load_model=None,
                load_regex=None,
@@ -34,6 +40,11 @@ class Agent:
       n_plays: int. Number of separate play (or evaluation) runs to execute when `Agent.play()` is called.
         If `<=0`, `Agent.play()` will raise exception. If `>0`, `Agent.train()` will raise exception
       save_period: int. Save the model every `save_period` training steps. `<=0` means no saving
+      async_save: bool. If True, `save()` only snapshots the data in memory and the disk I/O is
+        done in a background thread. `agent_state.json` is written last, after all other data
+      eval_worker: bool. If True, evaluation runs in a separate process, concurrently with training.
+        The worker evaluates a snapshot of the model variables taken when the evaluation is due,
+        saves the best agent and the evaluation statistics. Ignored in play mode
       load_model: str. Path to a directory which contains an existing model. The best_agent weights in
         this model will be loaded (no data in `load_model` will be overwritten)
       load_regex: str. Regular expression for matching variables whose values should be reused.
@@ -59,6 +70,21 @@ class Agent:
     self.train_saver    = None
     self.eval_saver     = None
 
+    # Asynchronous save data
+    self.async_save     = async_save
+    self._save_thread   = None
+    self._save_error    = None
+    self._save_writes   = None          # Disk writes deferred to the save thread
+    self._snapshot_op   = None
+    self._snapshot_saver = None
+
+    # Evaluation worker data
+    self.eval_worker    = eval_worker and n_plays <= 0
+    self._eval_proc     = None
+    self._eval_conn     = None
+    self._eval_pending  = False         # True if the worker is running an evaluation
+    self._eval_snapshot_saver = None
+
     # Training data
     self.agent_step     = 0             # Current agent step
     self.prng           = seeding.get_prng()
@@ -92,6 +118,10 @@ class Agent:
       return
     self.built = True
 
+    # Fork the evaluation worker before any TF session exists in this process
+    if self.eval_worker:
+      self._start_eval_worker()
+
     if os.path.exists(self.state_file):
       restore = True
       assert not self.play_mode
@@ -117,12 +147,43 @@ class Agent:
       self._reuse_vars()
 
     # NOTE: Create tf.train.Savers **after** building the whole graph
-    # Create a saver for the training model
-    self.train_saver = tf.train.Saver(max_to_keep=1, save_relative_paths=True)
+    # Create a saver for the training model. Keep 2 checkpoints, since the checkpoint of the last
+    # committed save must exist until the agent state of the next save is written
+    self.train_saver = tf.train.Saver(max_to_keep=2, save_relative_paths=True)
 
     # Create a separate saver for the best agent; does not include optimizer variables
     self.eval_saver = tf.train.Saver(self.model.variables, max_to_keep=1, save_relative_paths=True)
 
+    if self.async_save and not self.play_mode:
+      self._build_snapshot()
+
+    # Separate saver, since a Saver deletes old checkpoints, regardless of their directory
+    if self.eval_worker:
+      self._eval_snapshot_saver = tf.train.Saver(self.model.variables, max_to_keep=1,
+                                                 save_relative_paths=True)
+
+    # Let the saver remove the restored checkpoint once it is no longer needed
+    if restore:
+      self._remove_old_ckpts()
+      saver = self._snapshot_saver if self._snapshot_saver is not None else self.train_saver
+      saver.recover_last_checkpoints([self._restore_ckpt(self.agent_step)])
+
+
+  def _build_snapshot(self):
+    """Build in-memory copies of all variables, which are written to disk by the save thread.
+    The copies are saved under the names of the original variables, so the checkpoint is the same
+    as the one written by `self.train_saver`"""
+    variables = tf.global_variables()
+
+    with tf.device("/cpu:0"), tf.name_scope("save_snapshot"):
+      copies = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+                            collections=[]) for v in variables]
+      self._snapshot_op = tf.group(*[c.assign(v) for c, v in zip(copies, variables)])
+
+    var_list = {v.op.name: c for v, c in zip(variables, copies)}
+    self._snapshot_saver = tf.train.Saver(var_list, max_to_keep=2, save_relative_paths=True)
+    self.sess.run(tf.variables_initializer(copies))
+
 
   def train(self):
     """Train the agent"""
@@ -174,8 +235,12 @@ class Agent:
 
 
   def close(self):
+    # Wait for the evaluation in progress, unless terminating
+    self._stop_eval_worker()
+
     # Save before closing
     self.save()
+    self._wait_save()
 
     # Close the writers, the env and the session on exit
     self.sess.close()
@@ -204,10 +269,6 @@ class Agent:
   def _restore_vars(self):
     logger.info("Restoring model")
 
-    # Restore all variables
-    saver = tf.train.Saver()
-    saver.restore(self.sess, self.restore_ckpt)
-
     # Recover the agent state
     with open(self.state_file, 'r') as f:
       data = json.load(f)
@@ -215,6 +276,10 @@ class Agent:
     self.agent_step = data["train_step"]
     self.eval_step  = data["eval_step"]
 
+    # Restore all variables from the checkpoint of the committed save. A newer checkpoint might
+    # exist if the last save was interrupted before the agent state was written
+    self.model.restore(self.sess, self._restore_ckpt(self.agent_step))
+
 
   def _restore(self):
     """Execute agent-specific restore procedures"""
@@ -235,8 +300,7 @@ class Agent:
       logger.info(v.name)
 
     # Restore the best agent variables
-    saver = tf.train.Saver(var_list)
-    saver.restore(self.sess, self.reuse_ckpt)
+    self.model.restore(self.sess, self.reuse_ckpt, var_list)
 
 
   def _train(self):
@@ -249,6 +313,11 @@ class Agent:
     pass
 
 
+  def _configure_monitors(self):
+    """Overload in subclasses to configure the environment monitors after the graph is built"""
+    pass
+
+
   def _reset(self):
     """Reset method to be implemented by the inheriting class"""
     raise NotImplementedError()
@@ -281,13 +350,34 @@ class Agent:
 
   def _eval_agent(self):
     """Subclass helper function.
-    Execute a single evaluation run for the lenght of self.eval_len steps.
+    Execute a single evaluation run for the lenght of self.eval_len steps. If `self.eval_worker`,
+    the run is started in the evaluation worker and the function returns immediately.
     """
     if self.eval_len <= 0 or self.eval_period <= 0:
       return
 
+    if self._eval_proc is not None:
+      self._eval_agent_async()
+      return
+
     logger.info("Starting evaluation run")
 
+    best_agent = self._run_eval()
+
+    # Execute on successful run completion
+    if best_agent is not None:
+      self._save_best_agent(best_agent)     # Save agent if the best so far
+      self.eval_step += self.eval_len       # Update the eval step
+
+      logger.info("Evaluation run finished")
+
+
+  def _run_eval(self):
+    """Step the evaluation environment for `self.eval_len` steps, starting at `self.eval_step`
+    Returns:
+      bool. True if the agent is the best so far. None if the run was terminated
+    """
+
     # Compute the start and the end step
     start_step  = self.eval_step + 1
     stop_step   = start_step + self.eval_len
@@ -295,9 +385,9 @@ class Agent:
     # Reset the environment at the beginning
     obs = self.env_eval.reset()
 
-    for t in range(start_step, stop_step):
+    for _ in range(start_step, stop_step):
       if self._terminate:
-        break
+        return None
 
       action = self._action_eval(obs)
       next_obs, rew, done, info = self.env_eval.step(action)
@@ -307,13 +397,116 @@ class Agent:
         next_obs = self.env_eval.reset()
       obs = next_obs
 
-    # Execute on successful loop completion
+    return info["rltfmon.best_agent"]
+
+
+  def _start_eval_worker(self):
+    """Fork the evaluation worker process. Must be called before any TF session is created"""
+    ctx = multiprocessing.get_context("fork")
+
+    self._eval_conn, conn = ctx.Pipe()
+    self._eval_proc = ctx.Process(target=self._run_eval_worker, args=(conn,),
+                                  name="eval_worker", daemon=True)
+    self._eval_proc.start()
+    conn.close()
+
+
+  def _run_eval_worker(self, conn):
+    """Body of the evaluation worker process. The worker is a copy of the agent, which builds its
+    own graph and session. For every request, it restores the snapshot of the model variables,
+    takes the agent and eval steps of the snapshot and executes `self._eval_agent()`"""
+
+    # The main process handles interrupts and stops the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    self._eval_proc = None
+    self._eval_conn.close()
+    self._eval_conn = None
+
+    # The TensorBoard writer thread of the main process does not exist in the forked process
+    self.env_eval.monitor.stats_recorder.reopen_writer()
+
+    try:
+      self._build_graph()
+      self.eval_saver = tf.train.Saver(self.model.variables, max_to_keep=1, save_relative_paths=True)
+      self._configure_monitors()
+
+      while True:
+        cmd, data = conn.recv()
+        if cmd == "close":
+          break
+
+        ckpt_path, self.agent_step, self.eval_step = data
+        self.eval_saver.restore(self.sess, ckpt_path)
+
+        self._eval_agent()
+        self.env_eval.monitor.save()
+
+        conn.send(("ok", self.eval_step))
+
+    except EOFError:
+      # The main process exited
+      pass
+    except Exception: #pylint: disable=broad-except
+      conn.send(("error", traceback.format_exc()))
+    finally:
+      conn.close()
+
+
+  def _eval_agent_async(self):
+    """Snapshot the model variables and start an evaluation run in the evaluation worker"""
+
+    # Make sure the previous evaluation run is complete
+    self._wait_eval()
+
+    logger.info("Starting evaluation run in the evaluation worker")
+
+    # The agent step of the snapshot is the same as in `self._save_best_agent()`
+    ckpt_path = self._eval_snapshot_saver.save(self.sess, self.eval_ckpt_dir,
+                                               global_step=self.agent_step+1)
+
+    self._eval_conn.send(("eval", (ckpt_path, self.agent_step, self.eval_step)))
+    self._eval_pending = True
+
+
+  def _wait_eval(self, block=True):
+    """Collect the result of the evaluation run in progress in the evaluation worker, if any
+    Args:
+      block: bool. If False, return immediately if the run is not complete
+    """
+    if not self._eval_pending:
+      return
+    if not block and not self._eval_conn.poll():
+      return
+
+    try:
+      status, data = self._eval_conn.recv()
+    except EOFError:
+      raise RuntimeError("Evaluation worker exited unexpectedly")
+    if status == "error":
+      raise RuntimeError("Exception in evaluation worker:\n{}".format(data))
+
+    self.eval_step      = data
+    self._eval_pending  = False
+
+    logger.info("Evaluation run finished")
+
+
+  def _stop_eval_worker(self):
+    """Stop the evaluation worker. Wait for the evaluation run in progress, unless terminating"""
+    if self._eval_proc is None:
+      return
+
+    if self._terminate:
+      self._eval_proc.terminate()
     else:
-      best_agent = info["rltfmon.best_agent"]
-      self._save_best_agent(best_agent)     # Save agent if the best so far
-      self.eval_step = t                    # Update the eval step
+      self._wait_eval()
+      self._eval_conn.send(("close", None))
 
-      logger.info("Evaluation run finished")
+    self._eval_proc.join()
+    self._eval_conn.close()
+    self._eval_proc = None
+    self._eval_pending = False
 
 
   def _run_play(self):
@@ -330,11 +523,19 @@ class Agent:
     the agent state needs to be consistent, including train and eval steps, all model variables,
     possible monitors. Thus explicitly calling save is easier and more clear.
 
-    Calls `self._save()` for any subclass specific save procedures.
+    Calls `self._save()` for any subclass specific save procedures. If `self.async_save`, the
+    TF variables are copied in memory and the disk writes are executed in a background thread.
+    Subclasses can defer their writes to this thread with `self._defer_write()`.
     """
     if self.play_mode or not self._save_allowed():
       return
 
+    # Make sure the previous save is complete
+    self._wait_save()
+
+    # Collect the result of an evaluation run in the worker, if it is complete
+    self._wait_eval(block=False)
+
     # Check if the current state differs from the saved state
     if os.path.exists(self.state_file):
       with open(self.state_file, 'r') as f:
@@ -344,21 +545,86 @@ class Agent:
 
     logger.info("Saving the TF model and stats to %s", self.model_dir)
 
-    # Save the model
-    self.train_saver.save(self.sess, self.last_ckpt_dir, global_step=self.agent_step)
-
-    # Execute additional agent-specific save proceudres
-    self._save()
-
-    # Save the agent state
+    # Agent state
     data = {
       "train_step": self.agent_step,
       "eval_step":  self.eval_step,
     }
-    with open(self.state_file, 'w') as f:
-      json.dump(data, f, indent=4, sort_keys=True)
 
-    logger.info("Save finished successfully")
+    step = self.agent_step
+
+    if self.async_save:
+      # Snapshot the model variables
+      self.sess.run(self._snapshot_op)
+      saver = self._snapshot_saver
+    else:
+      saver = self.train_saver
+
+    self._save_writes = [lambda: saver.save(self.sess, self.last_ckpt_dir, global_step=step)]
+
+    # Execute additional agent-specific save proceudres
+    try:
+      self._save()
+    finally:
+      writes, self._save_writes = self._save_writes, None
+
+    if not self.async_save:
+      self._write_save(writes, data)
+      self._wait_save()
+      return
+
+    self._save_thread = threading.Thread(name="save_thread", target=self._write_save,
+                                         args=(writes, data))
+    self._save_thread.start()
+
+
+  def _defer_write(self, write):
+    """Execute `write` after `self._save()` returns - in the save thread if the current save is
+    asynchronous. Should be called from `self._save()`
+    Args:
+      write: callable. Takes no arguments and writes data to disk. Must not depend on any data
+        which is modified after `self._save()` returns. It can return a callable which removes the
+        data of older saves. The latter is called only after the agent state is committed
+    """
+    if self._save_writes is None:
+      clean = write()
+      if callable(clean):
+        clean()
+    else:
+      self._save_writes.append(write)
+
+
+  def _write_save(self, writes, data):
+    """Execute all deferred writes, commit the agent state and remove the data of older saves.
+    NOTE: A failed save is re-raised by the next call to `self._wait_save()`. Saves are thus never
+    started on top of a failed one and the data of the last committed save is never removed"""
+    try:
+      cleans = [write() for write in writes]
+      self._write_state(data)
+      for clean in cleans:
+        if callable(clean):
+          clean()
+      logger.info("Save finished successfully")
+    except Exception as e: #pylint: disable=broad-except
+      logger.exception("Saving the agent failed")
+      self._save_error = e
+
+
+  def _wait_save(self):
+    """Block until the asynchronous save in progress, if any, is complete"""
+    if self._save_thread is not None:
+      self._save_thread.join()
+      self._save_thread = None
+
+    if self._save_error is not None:
+      error, self._save_error = self._save_error, None
+      raise error
+
+
+  def _write_state(self, data):
+    """Atomically write the agent state. The file is the commit point of a save"""
+    with atomic_write.atomic_write(self.state_file) as f:
+      json.dump(data, f, indent=4, sort_keys=True)
 
 
   def _save(self):
@@ -401,14 +667,32 @@ class Agent:
     return os.path.join(self.model_dir, "snapshots/best/")
 
 
+  @property
+  def eval_ckpt_dir(self):
+    return os.path.join(self.model_dir, "snapshots/eval/")
+
+
   @property
   def reuse_ckpt(self):
     return self._ckpt_path(os.path.join(self.reuse_model, "snapshots/best/"))
 
 
-  @property
-  def restore_ckpt(self):
-    return self._ckpt_path(self.last_ckpt_dir)
+  def _remove_old_ckpts(self):
+    """Remove the training checkpoints older than the restored one. They are left behind by the
+    previous run, whose saver is gone. Newer checkpoints of interrupted saves are overwritten when
+    training reaches their step"""
+    for file in os.listdir(self.last_ckpt_dir):
+      match = re.match(r"^-(\d+)\.index$", file)
+      if match is not None and int(match.group(1)) < self.agent_step:
+        tf.train.remove_checkpoint("%s-%s" % (self.last_ckpt_dir, match.group(1)))
+
+
+  def _restore_ckpt(self, step):
+    """Return the path of the training checkpoint saved at agent step `step`"""
+    ckpt_path = "%s-%d" % (self.last_ckpt_dir, step)
+    if not tf.train.checkpoint_exists(ckpt_path):
+      raise ValueError("No checkpoint for step {} found in {}".format(step, self.last_ckpt_dir))
+    return ckpt_path
 
 
   def _ckpt_path(self, ckpt_dir):
@@ -1,7 +1,13 @@
 import logging
+import os
+import numpy as np
 import tensorflow as tf
 
-from rltf.agents import Agent
+from tensorflow.python.client import timeline
+
+from rltf.agents      import Agent
+from rltf.monitoring  import Profiler
+from rltf.monitoring  import profiler
 
 
 logger = logging.getLogger(__name__)
@@ -36,7 +42,8 @@ class LoggingAgent(Agent):
   """Abstract Agent which takes care of logging training and evaluation progress to stdout
   and TensorBoard. Also takes care of saving data to disk and restoring it"""
 
-  def __init__(self, *args, log_period=50000, video_period=1000, plot_video=False, **kwargs):
+  def __init__(self, *args, log_period=50000, video_period=1000, plot_video=False, profile=False,
+               trace_period=0, **kwargs):
     """
     Args:
       log_period: int. Add TensorBoard summary and print progress every log_period agent steps
@@ -44,6 +51,11 @@ class LoggingAgent(Agent):
         no recordings will be made
       plot_video: bool. If True, plots of some of the model tensor values will be included in video
         recordings by the monitor. Values appear together with the corresponding state
+      profile: bool. If True, time the phases of the training loop. The mean duration of every phase
+        is printed to stdout and the duration histograms are added to TensorBoard every log_period
+      trace_period: int. Period (in number of log periods) for capturing a full TF trace of a single
+        training run. The trace is saved as a Chrome trace JSON file in the TensorBoard directory
+        and added to TensorBoard. If <=0, no traces are captured
     """
     super().__init__(*args, **kwargs)
 
@@ -52,6 +64,10 @@ class LoggingAgent(Agent):
     self.plot_video   = plot_video
     self.summary      = None    # The most recent summary
     self.summary_op   = None    # TF op that contains all summaries
+    self.profiler     = Profiler(enabled=profile)
+    self._profile     = {}      # The phase statistics for the most recent log period
+    self.trace_period = trace_period
+    self._trace_log   = None    # The log period of the most recent trace
 
 
   def build(self):
@@ -67,7 +83,7 @@ class LoggingAgent(Agent):
 
   def _configure_monitors(self):
     # Set stdout data to log during training
-    self.env_train.monitor.set_stdout_logs(self._append_log_spec())
+    self.env_train.monitor.set_stdout_logs(self._append_log_spec() + self._profile_log_spec())
 
     # Set the function to fetch TensorBoard summaries during training
     self.env_train.monitor.set_summary_getter(self._fetch_summary)
@@ -92,13 +108,79 @@ class LoggingAgent(Agent):
     # Pass the real current training step
     self._append_summary(summary, self.agent_step+1)
 
+    # Add the phase timings since the last log
+    if self.profiler.enabled:
+      self._profile = self.profiler.collect()
+      profiler.add_summary(summary, self._profile)
+
     return summary
 
 
+  def _profile_log_spec(self):
+    """Build the stdout entries with the mean duration (in ms) of each phase in `self._profile_phases()`"""
+    if not self.profiler.enabled:
+      return []
+
+    def mean_ms(name):
+      stats = self._profile.get(name, None)
+      return 1000 * stats["mean"] if stats is not None else np.nan
+
+    return [("profile/%s_ms" % name, ".3f", lambda t, k=name: mean_ms(k)) for name in self._profile_phases()]
+
+
   def _save(self):
-    # Save the monitor statistics
+    # Save the monitor statistics. The evaluation worker saves the evaluation statistics
     self.env_train.monitor.save()
-    self.env_eval.monitor.save()
+    if not self.eval_worker:
+      self.env_eval.monitor.save()
+
+
+  def _run_train_op(self, fetches, feed_dict, step):
+    """Run a training op. If a trace is due, capture a full trace of the run. See `trace_period`
+    Args:
+      fetches: The fetches to pass to `sess.run()`
+      feed_dict: dict. feed_dict to feed to sess.run
+      step: int. Current **agent** step
+    Returns:
+      The result of `sess.run()`
+    """
+    if not self._trace_due(step):
+      return self.sess.run(fetches, feed_dict=feed_dict)
+
+    options   = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    metadata  = tf.RunMetadata()
+    result    = self.sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=metadata)
+
+    self._save_trace(metadata, step)
+    return result
+
+
+  def _trace_due(self, step):
+    """Return True for the first training run in every `trace_period`-th log period"""
+    if self.trace_period <= 0:
+      return False
+
+    log_n = step // self.log_period
+    if log_n % self.trace_period != 0 or log_n == self._trace_log:
+      return False
+
+    self._trace_log = log_n
+    return True
+
+
+  def _save_trace(self, run_metadata, step):
+    """Save a captured trace as a Chrome trace JSON file next to the TensorBoard files and add it to
+    TensorBoard. The JSON file can be opened at chrome://tracing"""
+    stats_recorder = self.env_train.monitor.stats_recorder
+
+    trace = timeline.Timeline(run_metadata.step_stats)
+    trace = trace.generate_chrome_trace_format(show_memory=True)
+    file  = os.path.join(stats_recorder.tb_dir, "trace_step_%d.json" % step)
+    with open(file, 'w') as f:
+      f.write(trace)
+
+    stats_recorder.tb_writer.add_run_metadata(run_metadata, "train_step_%d" % step, global_step=step)
+    logger.info("Saved TF trace of the training run at step %d in %s", step, file)
 
 
   def _run_summary_op(self, t, feed_dict):
@@ -128,6 +210,15 @@ class LoggingAgent(Agent):
     return []
 
 
+  def _profile_phases(self):
+    """To be overriden by the subclass
+    Returns:
+      List of the names of the profiled phases to report on stdout. Phases which are not listed
+      are reported only to TensorBoard
+    """
+    return []
+
+
   #pylint: disable=unused-argument
   def _append_summary(self, summary, t):
     """To be overriden by the subclass.
@@ -4,6 +4,7 @@ import gym
 import numpy as np
 
 from rltf.agents      import QlearnAgent
+from rltf.memory      import BaseBuffer
 from rltf.memory      import ReplayBuffer
 from rltf.monitoring  import Monitor
 
@@ -15,6 +16,8 @@ class AgentDDPG(QlearnAgent):
                model,
                action_noise,
                memory_size=int(1e6),
+               memory_mmap=False,
+               memory_compress=None,
                stack_frames=3,
                **agent_kwargs
               ):
@@ -24,6 +27,10 @@ class AgentDDPG(QlearnAgent):
       model: rltf.models.Model. TF implementation of a model network
       action_noise: rltf.exploration.ExplorationNoise. Additive action space exploration noise
       memory_size: int. Size of the replay buffer
+      memory_mmap: bool. If True, store the replay buffer in memory-mapped files in the buffer
+        save directory instead of in RAM. Saving the buffer then only flushes the files to disk
+      memory_compress: str or None. Codec for compressing image observations in the replay buffer,
+        "zlib" or "lz4". If None, observations are not compressed
       stack_frames: int. How many frames comprise a single state.
       agent_kwargs: Keyword arguments that will be passed to the Agent base class
     """
@@ -36,25 +43,36 @@ class AgentDDPG(QlearnAgent):
                       mode='t',
                       log_period=self.log_period,
                       video_spec=self.video_period,
+                      agent_step_size=self.n_envs,
                     )
 
     self.env_eval  = Monitor(
                       env=env_maker('e'),
                       log_dir=self.model_dir,
                       mode='e',
-                      log_period=self.eval_len,
+                      log_period=self.eval_len // self.n_eval_envs,
                       video_spec=self.video_period,
                       eval_period=self.eval_period,
                     )
 
+    self._make_train_envs(env_maker)
+    self._make_eval_envs(env_maker)
+
     self.action_noise = action_noise(self.env_train.action_space.shape)
 
+    # Independent noise processes for the additional training environments
+    self.action_noises = [self.action_noise]
+    for _ in range(1, self.n_envs):
+      self.action_noises.append(action_noise(self.env_train.action_space.shape))
+
     # Get environment specs
     obs_shape, obs_dtype, obs_len, act_shape = self._state_action_spec(stack_frames)
 
     # Initialize the model and the experience buffer
     self.model      = model(obs_shape=obs_shape, act_shape=act_shape, **self.model_kwargs)
-    self.replay_buf = ReplayBuffer(memory_size, obs_shape, obs_dtype, act_shape, np.float32, obs_len)
+    mmap_dir        = BaseBuffer.get_save_dir(self.model_dir) if memory_mmap else None
+    self.replay_buf = ReplayBuffer(memory_size, obs_shape, obs_dtype, act_shape, np.float32, obs_len,
+                                   mmap_dir=mmap_dir, compress=memory_compress, n_envs=self.n_envs)
 
     # Custom stats
     self.act_noise_stats = collections.deque([], maxlen=self.log_period)
@@ -78,6 +96,10 @@ class AgentDDPG(QlearnAgent):
     self.action_noise.reset()
 
 
+  def _reset_env(self, i):
+    self.action_noises[i].reset()
+
+
   def _stats_act_noise_mean(self, *_):
     if len(self.act_noise_stats) == 0:
       return float("nan")
@@ -114,12 +136,28 @@ class AgentDDPG(QlearnAgent):
     return action
 
 
+  def _actions_train(self, states, t):
+    noise   = np.stack([action_noise.sample(t) for action_noise in self.action_noises])
+    data    = self.model.batch_action_train_ops(self.sess, states)
+    actions = data["action"] + noise
+
+    # Add action noise to stats
+    self.act_noise_stats.extend(noise)
+
+    return actions
+
+
   def _action_eval(self, state):
     data    = self.model.action_eval_ops(self.sess, state)
     action  = data["action"][0]
     return action
 
 
+  def _actions_eval(self, states):
+    data    = self.model.batch_action_eval_ops(self.sess, states)
+    return data["action"]
+
+
   def _state_action_spec(self, stack_frames):
     assert isinstance(self.env_train.observation_space, gym.spaces.Box)
     assert isinstance(self.env_train.action_space,      gym.spaces.Box)
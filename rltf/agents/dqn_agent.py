@@ -2,6 +2,7 @@ import gym
 import numpy as np
 
 from rltf.agents      import QlearnAgent
+from rltf.memory      import BaseBuffer
 from rltf.memory      import ReplayBuffer
 from rltf.monitoring  import Monitor
 
@@ -14,6 +15,8 @@ class AgentDQN(QlearnAgent):
                epsilon_train,
                epsilon_eval,
                memory_size=int(1e6),
+               memory_mmap=False,
+               memory_compress=None,
                stack_frames=4,
                **agent_kwargs
               ):
@@ -24,6 +27,10 @@ class AgentDQN(QlearnAgent):
       epsilon_train: rltf.schedules.Schedule. Epsilon value for e-greedy exploration
       epsilon_eval: float. Epsilon value for selecting random action during evaluation
       memory_size: int. Size of the replay buffer
+      memory_mmap: bool. If True, store the replay buffer in memory-mapped files in the buffer
+        save directory instead of in RAM. Saving the buffer then only flushes the files to disk
+      memory_compress: str or None. Codec for compressing image observations in the replay buffer,
+        "zlib" or "lz4". If None, observations are not compressed
       stack_frames: int. How many frames comprise a single state.
       agent_kwargs: Keyword arguments that will be passed to the Agent base class
     """
@@ -36,17 +43,21 @@ class AgentDQN(QlearnAgent):
                       mode='t',
                       log_period=self.log_period,
                       video_spec=self.video_period,
+                      agent_step_size=self.n_envs,
                     )
 
     self.env_eval  = Monitor(
                       env=env_maker('e'),
                       log_dir=self.model_dir,
                       mode='e',
-                      log_period=self.eval_len,
+                      log_period=self.eval_len // self.n_eval_envs,
                       video_spec=self.video_period,
                       eval_period=self.eval_period,
                     )
 
+    self._make_train_envs(env_maker)
+    self._make_eval_envs(env_maker)
+
     self.epsilon_train  = epsilon_train
     self.epsilon_eval = epsilon_eval
 
@@ -55,7 +66,9 @@ class AgentDQN(QlearnAgent):
 
     # Initialize the model and the experience buffer
     self.model      = model(obs_shape=obs_shape, n_actions=n_actions, **self.model_kwargs)
-    self.replay_buf = ReplayBuffer(memory_size, obs_shape, obs_dtype, [], np.uint8, obs_len)
+    mmap_dir        = BaseBuffer.get_save_dir(self.model_dir) if memory_mmap else None
+    self.replay_buf = ReplayBuffer(memory_size, obs_shape, obs_dtype, [], np.uint8, obs_len,
+                                   mmap_dir=mmap_dir, compress=memory_compress, n_envs=self.n_envs)
 
 
   def _append_summary(self, summary, t):
@@ -86,6 +99,23 @@ class AgentDQN(QlearnAgent):
     return action
 
 
+  def _actions_train(self, states, t):
+    # Run epsilon greedy policy for each environment
+    epsilon = self.epsilon_train.value(t)
+    explore = self.prng.uniform(0, 1, size=len(states)) < epsilon
+
+    if np.all(explore):
+      actions = np.empty([len(states)], dtype=np.int32)
+    else:
+      # Run the network to select the actions for all environments at once
+      data    = self.model.batch_action_train_ops(self.sess, states)
+      actions = np.array(data["action"])
+
+    for i in np.flatnonzero(explore):
+      actions[i] = self.env_train.action_space.sample()
+    return actions
+
+
   def _action_eval(self, state):
     # Run epsilon greedy policy
     if self.prng.uniform(0,1) < self.epsilon_eval:
@@ -97,6 +127,22 @@ class AgentDQN(QlearnAgent):
     return action
 
 
+  def _actions_eval(self, states):
+    # Run epsilon greedy policy for each environment
+    explore = self.prng.uniform(0, 1, size=len(states)) < self.epsilon_eval
+
+    if np.all(explore):
+      actions = np.empty([len(states)], dtype=np.int32)
+    else:
+      # Run the network to select the actions for all environments at once
+      data    = self.model.batch_action_eval_ops(self.sess, states)
+      actions = np.array(data["action"])
+
+    for i in np.flatnonzero(explore):
+      actions[i] = self.env_eval.action_space.sample()
+    return actions
+
+
   def _reset(self):
     pass
 
@@ -123,16 +169,18 @@ class AgentDQN(QlearnAgent):
 
 class AgentBDQN(AgentDQN):
 
-  def __init__(self, blr_train_period, blr_batch_size, **kwargs):
+  def __init__(self, blr_train_period, blr_batch_size, blr_chunk_size=1024, **kwargs):
     """
     Args:
       blr_train_period: int. Period in number of steps at which to train the BLR
       blr_batch_size: int. Number of samples to train BLR in an update step
+      blr_chunk_size: int. Number of samples fed to the model in a single run when training BLR
     """
     super().__init__(**kwargs)
 
     self.blr_train_period = blr_train_period
     self.blr_batch_size = blr_batch_size
+    self.blr_chunk_size = blr_chunk_size
 
 
   def _run_train_step(self, t):
@@ -140,12 +188,18 @@ class AgentBDQN(AgentDQN):
 
     # Train BLR
     if t % self.blr_train_period == 0:
-      # for batch in self.replay_buf.random_data(self.blr_batch_size, self.batch_size):
-      #   feed_dict = self._get_feed_dict(batch, t)
-      #   self.sess.run(self.model.train_blr, feed_dict=feed_dict)
-
-      n = int(self.blr_batch_size / (self.batch_size * 4))
-      for _ in range(n):
-        batch = self.replay_buf.sample(self.batch_size)
-        feed_dict = self._get_feed_dict(batch, t)
-        self.sess.run(self.model.train_blr, feed_dict=feed_dict)
+      self._train_blr(t)
+
+
+  def _train_blr(self, t):
+    """Train the BLR on a large batch of samples. The batch is streamed through the model in chunks which
+    only accumulate the data in the graph. The posterior is then updated in a single run"""
+    n_samples = int(self.blr_batch_size / (self.batch_size * 4)) * self.batch_size
+
+    while n_samples > 0:
+      batch = self.replay_buf.sample(min(n_samples, self.blr_chunk_size))
+      feed_dict = self._get_feed_dict(batch, t)
+      self.sess.run(self.model.accum_blr, feed_dict=feed_dict)
+      n_samples -= self.blr_chunk_size
+
+    self.sess.run(self.model.update_blr)
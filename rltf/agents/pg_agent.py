@@ -174,7 +174,7 @@ class AgentPG(LoggingAgent):
     train_vf  = self.model.ops_dict["train_vf"]
 
     # Run a policy gradient step and a value function training step
-    self.sess.run([train_pi, train_vf], feed_dict=feed_dict)
+    self._run_train_op([train_pi, train_vf], feed_dict, t * self.rollout_len)
     # self.sess.run([self.model.train_op], feed_dict=feed_dict)
 
     # Run a policy gradient step
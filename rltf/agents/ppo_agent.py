@@ -39,7 +39,7 @@ class AgentPPO(AgentPG):
         feed_dict = self._get_feed_dict(batch, t)
 
         # Run a policy gradient step and a value function training step
-        self.sess.run(self.model.train_op, feed_dict=feed_dict)
+        self._run_train_op(self.model.train_op, feed_dict, t * self.rollout_len)
 
     # Run the summary op to log the changes from the update if necessary
     self._run_summary_op(t, feed_dict)
@@ -1,7 +1,16 @@
+import logging
+import os
 import threading
+import numpy as np
 
-from rltf.agents import LoggingAgent
-from rltf.agents import ThreadedAgent
+from rltf.agents      import LoggingAgent
+from rltf.agents      import ThreadedAgent
+from rltf.envs        import SubprocEnv
+from rltf.memory      import BatchPrefetcher
+from rltf.monitoring  import Monitor
+
+
+logger = logging.getLogger(__name__)
 
 
 class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
@@ -17,6 +26,10 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
                stop_step,
                *args,
                save_buf=True,
+               prefetch_workers=0,
+               prefetch_size=2,
+               n_envs=1,
+               n_eval_envs=1,
                **kwargs):
 
     """
@@ -28,6 +41,20 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
       stop_step: int. Total number of agent steps
       save_buf: bool. If True, save the buffer during calls to `self.save()`. Can also be disabled
         by setting the 'RLTFBUF' environment variable to `/dev/null`.
+      prefetch_workers: int. Number of background threads which sample training batches from the
+        replay buffer ahead of time. If `<=0`, batches are sampled in the training thread. Ignored
+        if the buffer runs in deterministic `sync` mode
+      prefetch_size: int. Maximum number of prefetched batches
+      n_envs: int. Number of training environments stepped in lockstep. If `>1`, the actions for
+        all environments are selected with a single `sess.run()` and every loop iteration advances
+        the agent step by `n_envs`. `eval_period`, `save_period`, `log_period` and `stop_step`
+        must be multiples of `n_envs`. Every environment has its own Monitor. The episodes of all
+        environments are added to the statistics of `self.env_train`, which logs at the agent step.
+        Not supported for models which sample a policy per episode (`model.episodic_policy`), e.g.
+        BstrapDQN and BDQN_TS
+      n_eval_envs: int. Number of evaluation environments stepped in lockstep. Must divide
+        `eval_len`. The evaluation actions are selected with a single `sess.run()`. The episodes
+        of all environments are merged into the statistics of `self.env_eval`
     """
     super().__init__(*args, **kwargs)
 
@@ -44,19 +71,111 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
     self.threads    = []
     self.save_buf   = save_buf
 
+    self.prefetch_workers = prefetch_workers
+    self.prefetch_size    = prefetch_size
+    self.prefetcher       = None
+
+    assert n_envs >= 1
+    self.n_envs     = n_envs
+    self.envs_train = None    # All training environments; `self.envs_train[0] == self.env_train`
+
+    # A loop iteration advances the agent step by n_envs, so periods must be crossed exactly
+    for name in ["eval_period", "save_period", "log_period", "stop_step"]:
+      period = getattr(self, name)
+      if 0 < period < np.inf and period % n_envs != 0:
+        raise ValueError("{}={} must be a multiple of n_envs={}".format(name, period, n_envs))
+
+    assert n_eval_envs >= 1
+    assert self.eval_len <= 0 or self.eval_len % n_eval_envs == 0
+    self.n_eval_envs  = n_eval_envs
+    self.envs_eval    = None  # All evaluation environments; `self.envs_eval[0] == self.env_eval`
+
 
   def _train(self):
     self._run_threads(self.threads)
 
+    # Stop sampling batches in the background
+    if self.prefetcher is not None:
+      self.prefetcher.stop()
+      self.prefetcher = None
+
+
+  def _build(self):
+    # The envs finish their episodes at different steps, so resampling the policy of the model at
+    # the end of one episode would change the policy of all other envs in the middle of their episodes
+    if self.n_envs > 1 and self.model.episodic_policy:
+      raise ValueError("Model {} samples a policy per episode and does not support "
+                       "n_envs > 1".format(self.model.name))
+    super()._build()
+
+
+  def _make_train_envs(self, env_maker):
+    """Create the additional training environments for `n_envs > 1`. Must be called after
+    `self.env_train` is created. The Monitors of the additional environments only record and save
+    statistics in their own directory and do not log or record videos
+    Args:
+      env_maker: callable. Function that takes the mode of an env and retruns a new environment instance
+    """
+    self.envs_train = [self.env_train]
+    for i in range(1, self.n_envs):
+      self.envs_train.append(Monitor(
+                              env=env_maker('t'),
+                              log_dir=os.path.join(self.model_dir, "env_%d" % i),
+                              mode='t',
+                              video_spec=False,
+                            ))
+
+
+  def _make_eval_envs(self, env_maker):
+    """Create the additional evaluation environments for `n_eval_envs > 1`. Must be called after
+    `self.env_eval` is created. The Monitors of the additional environments only track episodes,
+    which are merged into the statistics of `self.env_eval`
+    Args:
+      env_maker: callable. Function that takes the mode of an env and retruns a new environment instance
+    """
+    self.envs_eval = [self.env_eval]
+    for i in range(1, self.n_eval_envs):
+      self.envs_eval.append(Monitor(
+                              env=env_maker('e'),
+                              log_dir=os.path.join(self.model_dir, "eval_env_%d" % i),
+                              mode='t',
+                              video_spec=False,
+                            ))
+
+
+  def reset_env(self, i):
+    """Same as `self.reset()`, but for the i-th training environment. Must be called at the end of
+    every training episode of this environment
+    Returns:
+      obs: np.array. The result of `self.envs_train[i].reset()`
+    """
+    self._reset_env(i)
+    # Safe only because models with `episodic_policy` are restricted to a single env
+    self.model.reset(self.sess)
+    return self.envs_train[i].reset()
+
+
+  def _reset_env(self, i):
+    """Reset method for the i-th training environment. Defaults to `self._reset()`"""
+    self._reset()
+
+
+  def close(self):
+    super().close()
+    for env in (self.envs_train or [])[1:] + (self.envs_eval or [])[1:]:
+      env.close()
+
 
   def _restore(self):
-    self.replay_buf.restore(self.model_dir)
+    self.replay_buf.restore(self.model_dir, self.agent_step)
 
 
   def _save(self):
     super()._save()
+    for env in self.envs_train[1:]:
+      env.monitor.save()
     if self.save_buf:
-      self.replay_buf.save(self.model_dir)
+      self._defer_write(self.replay_buf.snapshot(self.model_dir, self.agent_step))
 
 
   def _save_allowed(self):
@@ -65,23 +184,51 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
 
   def _run_train_step(self, t):
     # Compose feed_dict
-    batch       = self.replay_buf.sample(self.batch_size)
-    feed_dict   = self._get_feed_dict(batch, t)
+    with self.profiler.phase("buf_sample"):
+      batch     = self._sample_batch()
+    with self.profiler.phase("feed_dict"):
+      feed_dict = self._get_feed_dict(batch, t)
 
     # Wait for synchronization if necessary
     self._wait_act_chosen()
 
     # Run a training step
-    self.sess.run(self.model.train_op, feed_dict=feed_dict)
+    with self.profiler.phase("train_op"):
+      self._run_train_op(self.model.train_op, feed_dict, t)
 
     # Update target network
     if t % self.target_update_period == 0:
-      self.sess.run(self.model.update_target)
+      with self.profiler.phase("update_target"):
+        self.sess.run(self.model.update_target)
 
     # Run the summary op to log the changes from the update if necessary
     self._run_summary_op(t, feed_dict)
 
 
+  def _sample_batch(self):
+    """Return a training batch from the replay buffer. If prefetching is enabled, the batch comes
+    from the prefetch queue. The prefetcher is started on the first call, when the buffer is
+    guaranteed to contain enough data"""
+    if self.prefetcher is None and self.prefetch_workers > 0:
+      if self.replay_buf.sync:
+        logger.warning("Replay buffer is in sync mode. Disabling batch prefetching.")
+        self.prefetch_workers = 0
+      else:
+        # Up to max(train_period, n_envs) transitions are stored per training step. Leave room
+        # for every batch that can be in flight at the same time
+        lookahead = max(self.train_period, self.n_envs)
+        lookahead = lookahead * (self.prefetch_workers + self.prefetch_size + 1)
+        self.prefetcher = BatchPrefetcher(self.replay_buf, self.batch_size,
+                                          n_workers=self.prefetch_workers,
+                                          queue_size=self.prefetch_size,
+                                          lookahead=lookahead)
+        self.prefetcher.start()
+
+    if self.prefetcher is not None:
+      return self.prefetcher.get()
+    return self.replay_buf.sample(self.batch_size)
+
+
   def _run_summary_op(self, t, feed_dict):
     # Remember this is called only each training period
     # Make sure to run the summary right before t gets to a log_period so as to make sure
@@ -96,6 +243,11 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
     raise NotImplementedError()
 
 
+  def _profile_phases(self):
+    return ["act", "env_step", "buf_store", "wait_train_done",
+            "buf_sample", "feed_dict", "wait_act_chosen", "train_op", "update_target"]
+
+
   def _action_train(self, state, t):
     """Return action selected by the agent for a training step
     Args:
@@ -105,6 +257,91 @@ class BaseQlearnAgent(LoggingAgent, ThreadedAgent):
     raise NotImplementedError()
 
 
+  def _actions_train(self, states, t):
+    """Return the actions selected by the agent for a training step in each training environment.
+    Should be overriden to select all actions with a single run of the model
+    Args:
+      states: np.array. Current states of all training environments, stacked along axis 0
+      t: int. Current timestep
+    Returns:
+      list or np.array of the actions for each environment
+    """
+    return [self._action_train(state, t) for state in states]
+
+
+  def _actions_eval(self, states):
+    """Return the actions selected by the agent for an evaluation step in each evaluation
+    environment. Should be overriden to select all actions with a single run of the model
+    Args:
+      states: np.array. Current states of all evaluation environments, stacked along axis 0
+    Returns:
+      list or np.array of the actions for each environment
+    """
+    return [self._action_eval(state) for state in states]
+
+
+  def _run_eval(self):
+    """Same as `Agent._run_eval()`, but steps all `n_eval_envs` evaluation environments in every
+    iteration. The evaluation step advances by `n_eval_envs`. The episodes completed by the
+    additional environments are added to the statistics of `self.env_eval` before it is stepped,
+    so the statistics at the end of the run include the episodes of all environments
+    """
+    if self.n_eval_envs == 1:
+      return super()._run_eval()
+
+    # Compute the start and the end step
+    n           = self.n_eval_envs
+    start_step  = self.eval_step + n
+    stop_step   = self.eval_step + self.eval_len + 1
+
+    # Number of episodes of each environment which are already in the stats of self.env_eval
+    n_eps = [len(env.stats_recorder.ep_rews) for env in self.envs_eval]
+
+    # Reset the environments at the beginning
+    obs = [env.reset() for env in self.envs_eval]
+
+    for _ in range(start_step, stop_step, n):
+      if self._terminate:
+        return None
+
+      actions = self._actions_eval(np.stack(obs))
+      self._step_async(self.envs_eval, actions)
+
+      # Step self.env_eval last, because its step at the end of the run logs the statistics
+      steps = [None] * n
+      for i in range(1, n):
+        steps[i] = self.envs_eval[i].step(actions[i])
+
+        stats = self.envs_eval[i].stats_recorder
+        if len(stats.ep_rews) > n_eps[i]:
+          self.env_eval.add_episodes(stats.ep_rews[n_eps[i]:], stats.ep_lens[n_eps[i]:])
+          n_eps[i] = len(stats.ep_rews)
+
+      steps[0] = self.env_eval.step(actions[0])
+      next_obs, _, dones, _ = zip(*steps)
+
+      # Reset the environments at the end of an episode
+      obs = [env.reset() if done else o for env, o, done in zip(self.envs_eval, next_obs, dones)]
+
+    info = steps[0][-1]
+    return info["rltfmon.best_agent"]
+
+
+  @staticmethod
+  def _step_async(envs, actions):
+    """Start stepping all environments which run in worker processes, so they are stepped in
+    parallel. The results are returned by the following calls to `env.step()`"""
+    for env, action in zip(envs, actions):
+      if isinstance(env.env, SubprocEnv):
+        env.env.step_async(action)
+
+
+  def _period_reached(self, t, period):
+    """Return True if a multiple of `period` is in the agent steps covered by a loop iteration,
+    which ends at step `t`. A single iteration steps all `n_envs` training environments"""
+    return t // period != (t - self.n_envs) // period
+
+
 
 class QlearnAgent(BaseQlearnAgent):
   """Runs the environment and trains the model in parallel using separate threads.
@@ -136,6 +373,9 @@ class QlearnAgent(BaseQlearnAgent):
     `self._train_model()` thread to start a new training step
     """
 
+    if self.n_envs > 1:
+      return self._run_envs()
+
     obs = self.reset()
 
     for t in range(self.agent_step+1, self.stop_step+1):
@@ -144,21 +384,24 @@ class QlearnAgent(BaseQlearnAgent):
         break
 
       # Get an action to run
-      if self.learn_started:
-        action = self._action_train(obs, t)
+      with self.profiler.phase("act"):
+        if self.learn_started:
+          action = self._action_train(obs, t)
 
-      # Choose random action if learning has not started
-      else:
-        action = self.env_train.action_space.sample()
+        # Choose random action if learning has not started
+        else:
+          action = self.env_train.action_space.sample()
 
       # Signal to net_thread that action is chosen
       self._signal_act_chosen()
 
       # Run action
-      next_obs, reward, done, _ = self.env_train.step(action)
+      with self.profiler.phase("env_step"):
+        next_obs, reward, done, _ = self.env_train.step(action)
 
       # Store the effect of the action taken upon obs
-      self.replay_buf.store(obs, action, reward, done)
+      with self.profiler.phase("buf_store"):
+        self.replay_buf.store(obs, action, reward, done)
 
       # Wait until net_thread is done
       self._wait_train_done()
@@ -188,6 +431,9 @@ class QlearnAgent(BaseQlearnAgent):
     `self._run_env()` thread to select a new action
     """
 
+    if self.n_envs > 1:
+      return self._train_model_envs()
+
     for t in range(self.agent_step+1, self.stop_step+1):
       if self._terminate:
         self._signal_train_done()
@@ -209,16 +455,120 @@ class QlearnAgent(BaseQlearnAgent):
       self._signal_train_done()
 
 
+  def _run_envs(self):
+    """Same as `self._run_env()`, but steps all `n_envs` training environments in every iteration.
+    The actions are selected with a single run of the model and all transitions are stored with a
+    single call to `self.replay_buf.store_batch()`. The agent step advances by `n_envs`. The episodes
+    completed by the additional environments are added to the statistics of `self.env_train` before
+    it is stepped, so its logs include the episodes of all environments
+    """
+    n   = self.n_envs
+    obs = [self.reset_env(i) for i in range(n)]
+
+    # Number of episodes of each environment which are already in the stats of self.env_train
+    n_eps = [len(env.stats_recorder.ep_rews) for env in self.envs_train]
+
+    for t in range(self.agent_step+n, self.stop_step+1, n):
+      if self._terminate:
+        self._signal_act_chosen()
+        break
+
+      # Get the actions to run
+      with self.profiler.phase("act"):
+        if self.learn_started:
+          actions = self._actions_train(np.stack(obs), t)
+
+        # Choose random actions if learning has not started
+        else:
+          actions = [env.action_space.sample() for env in self.envs_train]
+
+      # Signal to net_thread that the actions are chosen
+      self._signal_act_chosen()
+
+      # Run actions
+      with self.profiler.phase("env_step"):
+        self._step_async(self.envs_train, actions)
+
+        # Step self.env_train last, because its step logs the statistics at the end of a log period
+        steps = [None] * n
+        for i in range(1, n):
+          steps[i] = self.envs_train[i].step(actions[i])
+
+          stats = self.envs_train[i].stats_recorder
+          if len(stats.ep_rews) > n_eps[i]:
+            self.env_train.add_episodes(stats.ep_rews[n_eps[i]:], stats.ep_lens[n_eps[i]:])
+            n_eps[i] = len(stats.ep_rews)
+
+        steps[0] = self.env_train.step(actions[0])
+      next_obs, rewards, dones, _ = zip(*steps)
+
+      # Store the effect of the actions taken upon obs
+      with self.profiler.phase("buf_store"):
+        self.replay_buf.store_batch(np.stack(obs), np.stack(actions), np.asarray(rewards),
+                                    np.asarray(dones))
+
+      # Wait until net_thread is done
+      self._wait_train_done()
+
+      # Reset the environments at the end of an episode
+      obs = [self.reset_env(i) if done else o for i, (o, done) in enumerate(zip(next_obs, dones))]
+
+      # Stop and run evaluation procedure
+      if self.eval_len > 0 and self._period_reached(t, self.eval_period):
+        self._eval_agent()
+
+      # Update the agent step
+      self.agent_step = t
+
+      # Save **after** agent step is correct and completed
+      if self._period_reached(t, self.save_period):
+        self.save()
+
+
+  def _train_model_envs(self):
+    """Same as `self._train_model()`, but for `self._run_envs()`. In every iteration, runs all
+    training steps which fall in the `n_envs` agent steps covered by the iteration"""
+    n = self.n_envs
+
+    for t in range(self.agent_step+n, self.stop_step+1, n):
+      if self._terminate:
+        self._signal_train_done()
+        break
+
+      train_steps = [s for s in range(t-n+1, t+1) if s >= self.warm_up and s % self.train_period == 0]
+
+      if train_steps:
+
+        self.learn_started = True
+
+        # Run the training steps. The actions for this iteration are chosen only once, so let
+        # every step after the first one pass the wait in `self._run_train_step()`
+        for i, step in enumerate(train_steps):
+          if i > 0:
+            self._signal_act_chosen()
+          self._run_train_step(step)
+
+      else:
+        # Synchronize
+        self.replay_buf.wait_stored()
+        self.replay_buf.signal_sampled()
+        self._wait_act_chosen()
+
+      self._signal_train_done()
+
+
   def _wait_act_chosen(self):
     # Wait until an action is chosen to be run
-    while not self._act_chosen.is_set():
-      self._act_chosen.wait()
+    with self.profiler.phase("wait_act_chosen"):
+      while not self._act_chosen.is_set():
+        self._act_chosen.wait()
     self._act_chosen.clear()
 
   def _wait_train_done(self):
     # Wait until training step is done
-    while not self._train_done.is_set():
-      self._train_done.wait()
+    with self.profiler.phase("wait_train_done"):
+      while not self._train_done.is_set():
+        self._train_done.wait()
     self._train_done.clear()
 
   def _signal_act_chosen(self):
@@ -238,6 +588,8 @@ class SequentialQlearnAgent(BaseQlearnAgent):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
 
+    assert self.n_envs == 1, "SequentialQlearnAgent supports only a single training environment"
+
     # Use a thread in order to exit cleanly on KeyboardInterrupt
     # train_thread  = threading.Thread(name='train_thread', target=self._train_model)
     self.threads  = [threading.Thread(name='train_thread', target=self._thread, args=[self._train_model])]
@@ -252,18 +604,21 @@ class SequentialQlearnAgent(BaseQlearnAgent):
         break
 
       # Get an action to run
-      if self.learn_started:
-        action = self._action_train(obs, t)
+      with self.profiler.phase("act"):
+        if self.learn_started:
+          action = self._action_train(obs, t)
 
-      # Choose random action if learning has not started
-      else:
-        action = self.env_train.action_space.sample()
+        # Choose random action if learning has not started
+        else:
+          action = self.env_train.action_space.sample()
 
       # Run action
-      next_obs, reward, done, _ = self.env_train.step(action)
+      with self.profiler.phase("env_step"):
+        next_obs, reward, done, _ = self.env_train.step(action)
 
       # Store the effect of the action taken upon obs
-      self.replay_buf.store(obs, action, reward, done)
+      with self.profiler.phase("buf_store"):
+        self.replay_buf.store(obs, action, reward, done)
 
       # Reset the environment if end of episode
       if done:
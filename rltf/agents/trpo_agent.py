@@ -31,7 +31,8 @@ class AgentTRPO(AgentPG):
     self.sess.run(self.model.update_old_pi)
 
     # Compute the TNPG step and the policy surrogate gain before the update
-    pi_gain_lo, _ = self.sess.run([self.model.pi_gain, self.model.step_op], feed_dict=feed_dict)
+    pi_gain_lo, _ = self._run_train_op([self.model.pi_gain, self.model.step_op], feed_dict,
+                                       t * self.rollout_len)
 
     # Perform line search for the new policy
     self._line_search(pi_gain_lo, feed_dict)
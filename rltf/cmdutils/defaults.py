@@ -33,8 +33,19 @@ dqn_spec = dict(
   save_period=10**6,            # Period for saving progress (in number of *agent* steps)
   video_period=1000,            # Period for recording episode videos (in number of episodes)
   save_buf=True,                # Save the replay buffer
-  # environment arguments
-  env_kwargs=ArgSpec(dict, max_ep_steps_train=108000, max_ep_steps_eval=108000)
+  async_save=False,             # Write checkpoints to disk in a background thread
+  eval_worker=False,            # Run evaluation in a separate process, concurrently with training
+  memory_mmap=False,            # Keep the replay buffer in memory-mapped files on disk
+  memory_compress=None,         # Compress image observations in the replay buffer: zlib or lz4
+  prefetch_workers=0,           # Number of threads which prefetch training batches; 0 disables
+  n_envs=1,                     # Number of training environments stepped in lockstep
+  n_eval_envs=1,                # Number of evaluation environments stepped in lockstep
+  single_pass=False,            # Pass obs_t and obs_tp1 through the agent net as a single batch
+  profile=False,                # Time the phases of the training loop and report them each log_period
+  trace_period=0,               # Capture a TF trace of a train step every trace_period log periods
+  # environment arguments. fused: faster Atari frame preprocessing, which differs from older runs
+  env_kwargs=ArgSpec(dict, max_ep_steps_train=108000, max_ep_steps_eval=108000, subproc=False,
+                     fused=False)
 )
 
 
@@ -84,6 +95,7 @@ QRDQN = {**dqn_spec, **dict(
   model=models.QRDQN,
   N=200,                        # Number of quantiles
   k=1,                          # Quantile Huber loss order
+  loss_chunk=None,              # Target quantiles per loss chunk. Must divide N. None for no chunking
   opt_conf=ArgSpec(OptimizerConf, opt_type=tf.train.AdamOptimizer, learn_rate=5e-5, epsilon=.01/32),
   epsilon_train=ArgSpec(PiecewiseSchedule, endpoints=[(0, 1.0), (10**6, 0.01)], outside_value=0.01),
   epsilon_eval=0.001,
@@ -107,6 +119,7 @@ BDQN = {**dqn_spec, **dict(
   epsilon_eval=0.001,
   blr_train_period=10000,
   blr_batch_size=10000,
+  blr_chunk_size=1024,          # Number of samples in a single BLR training run
 )}
 
 BDQN_IDS = {**dqn_spec, **dict(
@@ -122,6 +135,7 @@ BDQN_IDS = {**dqn_spec, **dict(
   target_update_period=40000,
   blr_train_period=40000,
   blr_batch_size=40000,
+  blr_chunk_size=1024,          # Number of samples in a single BLR training run
 )}
 
 BDQN_TS  = {**BDQN}
@@ -161,10 +175,20 @@ DDPG = dict(
   eval_len=50000,               # Lenght of each evaluation run (in number of *agent* steps)
   log_period=50000,             # Period for logging progress (in number of *agent* steps)
   video_period=1000,            # Period for recording episode videos (in number of episodes)
+  profile=False,                # Time the phases of the training loop and report them each log_period
+  trace_period=0,               # Capture a TF trace of a train step every trace_period log periods
   save_period=500000,           # Period for saving progress (in number of *agent* steps)
   save_buf=True,                # Save the replay buffer
+  async_save=False,             # Write checkpoints to disk in a background thread
+  eval_worker=False,            # Run evaluation in a separate process, concurrently with training
+  memory_mmap=False,            # Keep the replay buffer in memory-mapped files on disk
+  memory_compress=None,         # Compress image observations in the replay buffer: zlib or lz4
+  prefetch_workers=0,           # Number of threads which prefetch training batches; 0 disables
+  n_envs=1,                     # Number of training environments stepped in lockstep
+  n_eval_envs=1,                # Number of evaluation environments stepped in lockstep
   # environment arguments
-  env_kwargs=ArgSpec(dict, max_ep_steps_train=None, max_ep_steps_eval=None, rew_scale=1.0)
+  env_kwargs=ArgSpec(dict, max_ep_steps_train=None, max_ep_steps_eval=None, rew_scale=1.0,
+                     subproc=False)
 )
 
 
@@ -187,6 +211,7 @@ REINFORCE = dict(
   eval_len=1000,                # Lenght of each evaluation run (in number of *agent* steps)
   log_period=10000,             # Period for logging progress (in number of *agent* steps)
   video_period=1000,            # Period for recording episode videos (in number of episodes)
+  trace_period=0,               # Capture a TF trace of a train step every trace_period log periods
   save_period=-1,               # Period for saving progress (in number of *agent* steps)
   # environment arguments
   env_kwargs=ArgSpec(dict, max_ep_steps_train=None, max_ep_steps_eval=None, rew_scale=1.0),
@@ -219,6 +244,7 @@ PPO = dict(
   eval_len=2048,                # Lenght of each evaluation run (in number of *agent* steps)
   log_period=20480,             # Period for logging progress (in number of *agent* steps)
   video_period=1000,            # Period for recording episode videos (in number of episodes)
+  trace_period=0,               # Capture a TF trace of a train step every trace_period log periods
   save_period=-1,               # Period for saving progress (in number of *agent* steps)
   # environment arguments
   env_kwargs=ArgSpec(dict, max_ep_steps_train=None, max_ep_steps_eval=None, rew_scale=1.0),
@@ -249,6 +275,7 @@ TRPO = dict(
   eval_len=4096,                # Lenght of each evaluation run (in number of *agent* steps)
   log_period=20480,             # Period for logging progress (in number of *agent* steps)
   video_period=1000,            # Period for recording episode videos (in number of episodes)
+  trace_period=0,               # Capture a TF trace of a train step every trace_period log periods
   save_period=-1,               # Period for saving progress (in number of *epochs*)
   # environment arguments
   env_kwargs=ArgSpec(dict, max_ep_steps_train=None, max_ep_steps_eval=None, rew_scale=1.0),
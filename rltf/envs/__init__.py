@@ -2,4 +2,5 @@ from rltf.envs.atari    import wrap_deepmind_atari
 from rltf.envs.common   import wrap_ddpg
 from rltf.envs.common   import wrap_dqn
 from rltf.envs.common   import wrap_pg
+from rltf.envs.subproc  import SubprocEnv
 from rltf.envs.wrappers import MaxEpisodeLen
@@ -24,7 +24,6 @@
 #
 
 import logging
-from collections import deque
 
 import cv2
 import gym
@@ -183,6 +182,67 @@ class WarpFrame(gym.ObservationWrapper):
     return observation[:, :, None]
 
 
+class MaxAndWarpFrame(gym.Wrapper):
+  """Fused `MaxAndRepeatEnv` and `WarpFrame`. Repeat an action `repeat` times, max-pool the last 2
+  frames in grayscale and resize the result to 84x84. If the env exposes the ALE, the grayscale
+  screens are read directly from the emulator. All work is done in preallocated buffers.
+  NOTE:
+    - Frames are converted to grayscale before the max, instead of after. The result differs
+      slightly from `MaxAndRepeatEnv` followed by `WarpFrame`
+    - The returned observation is reused and remains valid only until the next step or reset
+  """
+
+  def __init__(self, env, repeat=4):
+    super().__init__(env)
+    self.width  = 84
+    self.height = 84
+    shape = (self.height, self.width, 1)
+    self.observation_space = gym.spaces.Box(low=0, high=255, shape=shape, dtype=np.uint8)
+
+    self._ale       = getattr(env.unwrapped, "ale", None)
+    self._repeat    = repeat
+    assert self._repeat >= 1
+
+    screen_shape    = env.observation_space.shape[:2]
+    self._gray_buf  = np.zeros((2,)+screen_shape, dtype=np.uint8)   # Last 2 grayscale screens
+    self._max_frame = np.zeros(screen_shape, dtype=np.uint8)
+    self._out       = np.zeros((self.height, self.width), dtype=np.uint8)
+
+  #pylint: disable=method-hidden
+  def step(self, action):
+    """Repeat action, sum reward, and max over last observations."""
+    total_reward = 0.0
+    for i in range(self._repeat):
+      obs, reward, done, info = self.env.step(action)
+      if i == self._repeat - 2: self._grayscale(obs, self._gray_buf[0])
+      if i == self._repeat - 1: self._grayscale(obs, self._gray_buf[1])
+      total_reward += reward
+      if done:
+        break
+
+    # NOTE: The observation on the done=True doesn't matter - it is never used
+    np.maximum(self._gray_buf[0], self._gray_buf[1], out=self._max_frame)
+
+    return self._warp(self._max_frame), total_reward, done, info
+
+  #pylint: disable=method-hidden
+  def reset(self, **kwargs):
+    obs = self.env.reset(**kwargs)
+    self._grayscale(obs, self._max_frame)
+    return self._warp(self._max_frame)
+
+  def _grayscale(self, obs, out):
+    if self._ale is not None:
+      self._ale.getScreenGrayscale(out)
+    else:
+      # COLOR_RGB2GRAY is eqivalent to Y channel
+      cv2.cvtColor(obs, cv2.COLOR_RGB2GRAY, dst=out)
+
+  def _warp(self, frame):
+    cv2.resize(frame, (self.width, self.height), dst=self._out, interpolation=cv2.INTER_AREA)
+    return self._out[:, :, None]
+
+
 class ClippedRewardsWrapper(gym.RewardWrapper):
   """Clip rewards in [-1, 1] range. NOTE: apply only for TRAINING MODE."""
 
@@ -191,41 +251,74 @@ class ClippedRewardsWrapper(gym.RewardWrapper):
 
 
 class StackFrames(gym.Wrapper):
-  """Stack the last k frames - done by DeepMind to infer object velocities."""
+  """Stack the last k frames - done by DeepMind to infer object velocities.
+  Frames are written into a preallocated ring buffer, which keeps a copy of its first `k-1` slots
+  after its end. Thus the last k frames are always contiguous and every observation is a view of
+  the buffer - the stack is never concatenated. In particular, `BaseBuffer.store()` slices out
+  only the newest frame of the view.
+  NOTE: Returned observations are read-only and remain valid for k more steps of the environment.
+  Copy an observation if it must be kept for longer.
+  """
 
   def __init__(self, env, k=4):
     super().__init__(env)
     self.k        = k
-    self.obs_buf  = deque([], maxlen=k)
-    state_shape   = list(env.observation_space.shape)
+    obs_shape     = list(env.observation_space.shape)
+    state_shape   = list(obs_shape)
     state_shape[-1] *= k
     dtype         = env.observation_space.dtype
     self.observation_space = gym.spaces.Box(low=0, high=255, shape=state_shape, dtype=dtype)
 
+    self._n_ch    = obs_shape[-1]   # Number of channels of a single frame
+    self._size    = 2 * k           # Number of slots in the ring
+    self._idx     = -1              # Slot of the newest frame
+    ring_shape    = obs_shape[:-1] + [(self._size + k - 1) * self._n_ch]
+    self._ring    = np.zeros(ring_shape, dtype=dtype)
+
   #pylint: disable=method-hidden
   def step(self, action):
     obs, reward, done, info = self.env.step(action)
-    self.obs_buf.append(obs)
+    self._append(obs)
     return self._obs(), reward, done, info
 
   #pylint: disable=method-hidden
   def reset(self, **kwargs):
     obs = self.env.reset(**kwargs)
     for _ in range(self.k):
-      self.obs_buf.append(obs)
+      self._append(obs)
     return self._obs()
 
+  def _append(self, obs):
+    self._idx = (self._idx + 1) % self._size
+    self._write(self._idx, obs)
+    # Mirror the first k-1 slots after the end of the ring
+    if self._idx < self.k - 1:
+      self._write(self._size + self._idx, obs)
+
+  def _write(self, slot, obs):
+    c = self._n_ch
+    self._ring[..., slot*c:(slot+1)*c] = obs
+
   def _obs(self):
-    assert len(self.obs_buf) == self.k
-    return np.concatenate(self.obs_buf, axis=-1)
+    # If the stack wraps around the end of the ring, use the mirrored slots
+    hi = self._idx + 1
+    if hi < self.k:
+      hi += self._size
+    c   = self._n_ch
+    obs = self._ring[..., (hi-self.k)*c:hi*c]
+    obs.flags.writeable = False
+    return obs
 
 
-def wrap_deepmind_atari(env, mode, stack=4):
+def wrap_deepmind_atari(env, mode, stack=4, fused=False):
   """Wraps an Atari environment to have the same settings as in the original DQN Nature paper by Deepmind.
   Args:
     env: gym.Env
     mode: str, either 't' or 'e'. Mode in which the environment will be run - train or eval
     stack: int. Number of frames to stack that comrise the agent observation
+    fused: bool. If True, preprocess frames with the faster `MaxAndWarpFrame`. The observations differ
+      slightly from the default `MaxAndRepeatEnv` and `WarpFrame`, which reproduce the preprocessing of
+      older runs and of saved models exactly
   Returns:
     The wrapped environment
   """
@@ -237,10 +330,14 @@ def wrap_deepmind_atari(env, mode, stack=4):
   if mode == 't':
     env = EpisodicLifeEnv(env)
   env = NoopResetEnv(env, noop_max=30)
-  env = MaxAndRepeatEnv(env, repeat=4)
+  if fused:
+    env = MaxAndWarpFrame(env, repeat=4)
+  else:
+    env = MaxAndRepeatEnv(env, repeat=4)
   if 'FIRE' in env.unwrapped.get_action_meanings():
     env = FireResetEnv(env)
-  env = WarpFrame(env)
+  if not fused:
+    env = WarpFrame(env)
   if mode == 't':
     env = ClippedRewardsWrapper(env)
   env = StackFrames(env, k=stack)
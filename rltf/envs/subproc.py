@@ -0,0 +1,263 @@
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import traceback
+
+import gym
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class SubprocEnv(gym.Wrapper):
+  """Runs an environment in a separate worker process, which frees the main process (and the GIL)
+  from env emulation and preprocessing. The worker writes observations into a shared-memory array
+  and only the action, reward, done and info are sent over a pipe. Observations are never pickled.
+
+  The worker process owns the base environment and all of its wrappers. Steps and resets of the
+  base environment (or its MaxEpisodeLen wrapper) are recorded in the worker and replayed on
+  `self.env` in the main process. Hence `rltf.monitoring.Monitor` attaches to `self.env` as usual
+  and records the raw environment episode stats. Video frames are rendered by the worker at the
+  time the step is replayed, i.e. after the full wrapped step has finished.
+
+  The worker is forked, so a `SubprocEnv` should be created before the TF session is started.
+  Use `step_async()` and `step_wait()` to step several `SubprocEnv`s in parallel.
+  """
+
+  def __init__(self, make_env, wrap=None):
+    """
+    Args:
+      make_env: callable. Called in the worker process. Must return the base environment, wrapped
+        in MaxEpisodeLen if needed
+      wrap: callable or None. Called in the worker process. Must take the environment returned by
+        `make_env` and return the fully wrapped environment
+    """
+    ctx = multiprocessing.get_context("fork")
+
+    self._conn, worker_conn = ctx.Pipe()
+    self._process = ctx.Process(target=_worker, args=(worker_conn, self._conn, make_env, wrap),
+                                name="SubprocEnv", daemon=True)
+    self._process.start()
+    worker_conn.close()
+
+    # Map the shared observation memory. The file is only needed until both processes map it
+    spec = self._recv()
+    self._obs = np.memmap(spec["path"], dtype=spec["observation_space"].dtype, mode="r",
+                          shape=spec["obs_shape"])
+    os.remove(spec["path"])
+
+    self._waiting = False
+    self._closed  = False
+
+    super().__init__(_RemoteEnv(self, spec))
+
+    self.observation_space  = spec["observation_space"]
+    self.action_space       = spec["action_space"]
+    self.reward_range       = spec["reward_range"]
+    self.metadata           = spec["metadata"]
+
+
+  def step_async(self, action):
+    """Send `action` to the worker and return without waiting for the step to finish"""
+    assert not self._waiting
+    self._conn.send(("step", action))
+    self._waiting = True
+
+
+  def step_wait(self):
+    """Wait for the step started with `step_async()` to finish and return its result"""
+    assert self._waiting
+    reward, done, info, events = self._recv()
+    self._waiting = False
+    self._replay(events)
+    return np.array(self._obs), reward, done, info
+
+
+  #pylint: disable=method-hidden
+  def step(self, action):
+    """Step the environment. If `step_async()` was already called, `action` is ignored and the
+    result of the pending step is returned"""
+    if not self._waiting:
+      self.step_async(action)
+    return self.step_wait()
+
+
+  #pylint: disable=method-hidden
+  def reset(self, **kwargs):
+    assert not self._waiting
+    self._conn.send(("reset", kwargs))
+    events = self._recv()
+    self._replay(events)
+    return np.array(self._obs)
+
+
+  def seed(self, seed=None):
+    # The environment is seeded in the worker when it is created
+    return None
+
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      if self._waiting:
+        self._recv()
+      self._conn.send(("close", None))
+      self._conn.recv()
+    except (EOFError, OSError, RuntimeError):
+      pass
+    self._conn.close()
+    self._process.join(timeout=5)
+    if self._process.is_alive():
+      self._process.terminate()
+
+
+  def _render(self, mode):
+    assert not self._waiting
+    self._conn.send(("render", mode))
+    return self._recv()
+
+
+  def _replay(self, events):
+    """Replay the steps and resets of the base environment in the worker on `self.env`"""
+    for event in events:
+      if event[0] == "reset":
+        self.env.reset()
+      else:
+        self.env.step(event)
+
+
+  def _recv(self):
+    try:
+      status, data = self._conn.recv()
+    except EOFError:
+      raise RuntimeError("SubprocEnv worker process exited unexpectedly")
+    if status == "error":
+      raise RuntimeError("Exception in SubprocEnv worker process:\n{}".format(data))
+    return data
+
+
+
+class _RemoteEnv(gym.Env):
+  """Stand-in in the main process for the base environment in the worker. Its `step()` takes a
+  recorded ("step", reward, done) event instead of an action and returns no observation"""
+
+  def __init__(self, proc_env, spec):
+    self._proc_env          = proc_env
+    self.observation_space  = spec["base_observation_space"]
+    self.action_space       = spec["base_action_space"]
+    self.reward_range       = spec["reward_range"]
+    self.metadata           = spec["metadata"]
+    self.spec               = spec["spec"]
+
+  #pylint: disable=method-hidden
+  def step(self, action):
+    _, reward, done = action
+    return None, reward, done, {}
+
+  #pylint: disable=method-hidden
+  def reset(self, **kwargs):
+    return None
+
+  #pylint: disable=method-hidden
+  def render(self, mode='human'):
+    return self._proc_env._render(mode)
+
+  def close(self):
+    pass
+
+  def seed(self, seed=None):
+    return None
+
+
+
+class _EventRecorder(gym.Wrapper):
+  """Records the steps and resets of the base environment in the worker process"""
+
+  def __init__(self, env):
+    super().__init__(env)
+    self.events = []
+
+  def step(self, action):
+    obs, reward, done, info = self.env.step(action)
+    self.events.append(("step", reward, done))
+    return obs, reward, done, info
+
+  def reset(self, **kwargs):
+    self.events.append(("reset",))
+    return self.env.reset(**kwargs)
+
+  def pop_events(self):
+    events, self.events = self.events, []
+    return events
+
+
+
+def _worker(conn, parent_conn, make_env, wrap):
+  """Body of the SubprocEnv worker process"""
+
+  # The main process handles interrupts and closes the workers
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  parent_conn.close()
+
+  env = None
+  try:
+    base_env  = _EventRecorder(make_env())
+    env       = wrap(base_env) if wrap is not None else base_env
+
+    # Allocate the shared observation memory in RAM-backed storage if available
+    shm_dir   = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path  = tempfile.mkstemp(prefix="rltf_env_", dir=shm_dir)
+    os.close(fd)
+    obs_shape = env.observation_space.shape
+    obs       = np.memmap(path, dtype=env.observation_space.dtype, mode="w+", shape=obs_shape)
+
+    conn.send(("ok", dict(
+      path=path,
+      obs_shape=obs_shape,
+      observation_space=env.observation_space,
+      action_space=env.action_space,
+      base_observation_space=base_env.observation_space,
+      base_action_space=base_env.action_space,
+      reward_range=env.reward_range,
+      metadata=env.metadata,
+      spec=base_env.spec,
+    )))
+
+    while True:
+      cmd, data = conn.recv()
+      if cmd == "step":
+        obs[:], reward, done, info = env.step(data)
+        conn.send(("ok", (reward, done, info, base_env.pop_events())))
+      elif cmd == "reset":
+        obs[:] = env.reset(**data)
+        conn.send(("ok", base_env.pop_events()))
+      elif cmd == "render":
+        conn.send(("ok", base_env.render(data)))
+      elif cmd == "close":
+        env.close()
+        env = None
+        conn.send(("ok", None))
+        break
+      else:
+        raise ValueError("Unknown SubprocEnv command '{}'".format(cmd))
+
+  except (EOFError, BrokenPipeError):
+    # The main process exited
+    pass
+  except Exception: #pylint: disable=broad-except
+    try:
+      conn.send(("error", traceback.format_exc()))
+    except (OSError, BrokenPipeError):
+      pass
+  finally:
+    if env is not None:
+      try:
+        env.close()
+      except Exception: #pylint: disable=broad-except
+        logger.exception("Failed to close environment in SubprocEnv worker")
+    conn.close()
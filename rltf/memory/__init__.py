@@ -1,3 +1,5 @@
-from rltf.memory.base_buffer    import BaseBuffer
-from rltf.memory.replay_buffer  import ReplayBuffer
-from rltf.memory.pg_buffer      import PGBuffer
+from rltf.memory.base_buffer        import BaseBuffer
+from rltf.memory.replay_buffer      import ReplayBuffer
+from rltf.memory.pg_buffer          import PGBuffer
+from rltf.memory.prioritized_buffer import PrioritizedReplayBuffer
+from rltf.memory.prefetcher         import BatchPrefetcher
@@ -1,9 +1,11 @@
 import json
 import logging
 import os
+import re
 import numpy as np
 
 from gym.utils  import atomic_write
+from rltf.memory.compressed_frames import CompressedFrames
 from rltf.utils import rltf_conf
 from rltf.utils import seeding
 
@@ -15,7 +17,8 @@ class BaseBuffer():
   """Abstract buffer that saves agent experience. Supports both image and low-dimensional observations.
   Very memory efficient implementation in the case of images."""
 
-  def __init__(self, size, state_shape, obs_dtype, act_shape, act_dtype, obs_len):
+  def __init__(self, size, state_shape, obs_dtype, act_shape, act_dtype, obs_len, mmap_dir=None,
+               compress=None):
     """
     Args:
       state_shape: tuple or list. Shape of what is consedered to be a single state (not observation).
@@ -30,6 +33,13 @@ class BaseBuffer():
         stacked consecutive observations (images) and `obs_shape[-1] == state_shape[-1] / obs_len`.
         In this case the buffer stores observations separately and automatically reconstructs the
         full states when queried. Corresponds to the order of the MDP.
+      mmap_dir: str or None. If not None, `obs`, `action`, `reward` and `done` are stored in
+        memory-mapped `.npy` files in this directory instead of in RAM. Existing files with the
+        correct shape are reused. Saving the buffer to the same directory only flushes the files.
+        Should normally be `BaseBuffer.get_save_dir(model_dir)`
+      compress: str or None. If not None, every image observation is compressed separately in
+        memory with the given codec - "zlib" or "lz4". See `CompressedFrames`. Data on disk is not
+        compressed. Cannot be used together with `mmap_dir`
     """
 
     # Compute the observation shape
@@ -42,16 +52,60 @@ class BaseBuffer():
     self.max_size   = int(size)
     self.size_now   = 0
     self.next_idx   = 0
+    self.n_envs     = 1   # Number of interleaved environment streams. See `store_batch()`
     # self.new_idx    = 0
 
     # Create the buffers
-    self.obs    = np.empty([self.max_size] + self.obs_shape,  dtype=obs_dtype)
-    self.action = np.empty([self.max_size] + self.act_shape,  dtype=act_dtype)
-    self.reward = np.empty([self.max_size],                   dtype=np.float32)
-    self.done   = np.empty([self.max_size],                   dtype=np.bool)
+    self.mmap_dir = mmap_dir
+    if compress is not None:
+      assert len(self.obs_shape) == 3, "Only image observations can be compressed"
+      assert mmap_dir is None, "Compressed observations cannot be memory-mapped"
+      self.obs  = CompressedFrames(self.max_size, self.obs_shape, obs_dtype, codec=compress)
+    else:
+      self.obs  = self._alloc("obs",  [self.max_size] + self.obs_shape,  dtype=obs_dtype)
+    self.action = self._alloc("act",  [self.max_size] + self.act_shape,  dtype=act_dtype)
+    self.reward = self._alloc("rew",  [self.max_size],                   dtype=np.float32)
+    self.done   = self._alloc("done", [self.max_size],                   dtype=np.bool)
 
     self.prng   = seeding.get_prng()
 
+    # Incremental checkpointing state. See `save()`
+    self._chunk_len     = self._get_chunk_len()
+    self._n_dirty       = 0     # Number of transitions stored since the last save
+    self._saved_chunks  = []    # Save id of the file holding each chunk
+    self._saved_dir     = None  # Directory of the last save
+    self._save_id       = 0
+
+
+  def _alloc(self, name, shape, dtype):
+    """Allocate a buffer array either in RAM or as a memory-mapped file in `self.mmap_dir`"""
+    if self.mmap_dir is None:
+      return np.empty(shape, dtype=dtype)
+
+    file = self._mmap_file(self.mmap_dir, name)
+
+    # Reuse the file if it already holds the buffer data, e.g. when the agent is restored
+    if os.path.exists(file):
+      data = np.load(file, mmap_mode="r+")
+      if list(data.shape) == list(shape) and data.dtype == np.dtype(dtype):
+        return data
+      logger.warning("Overwriting memory-mapped buffer file %s with mismatching shape", file)
+      del data
+
+    return np.lib.format.open_memmap(file, mode="w+", shape=tuple(shape), dtype=dtype)
+
+
+  def _get_chunk_len(self, chunk_bytes=2**26):
+    """Number of transitions in a single checkpoint chunk, such that a chunk of `obs` is
+    about `chunk_bytes` large"""
+    row_bytes = np.dtype(self.obs.dtype).itemsize * int(np.prod(self.obs_shape))
+    return max(1, chunk_bytes // max(1, row_bytes))
+
+
+  @staticmethod
+  def _mmap_file(save_dir, name):
+    return os.path.join(save_dir, "mmap_" + name + ".npy")
+
 
   @staticmethod
   def _get_obs_shape(state_shape, obs_len, obs_dtype):
@@ -103,6 +157,36 @@ class BaseBuffer():
 
     self.next_idx = (self.next_idx + 1) % self.max_size
     self.size_now = min(self.max_size, self.size_now + 1)
+    self._n_dirty += 1
+
+
+  def store_batch(self, obs_t, act_t, rew_tp1, done_tp1):
+    """Store one transition for each of `n_envs` environments, which are stepped in lockstep.
+    The transitions are stored at consecutive indices, so the data of every environment is
+    interleaved with stride `n_envs`. This must be the only way data is stored if `n_envs > 1`.
+    Args:
+      obs_t: `np.array`, of shape `[n_envs] + state_shape`. See `store()`
+      act_t: `np.array`, of shape `[n_envs] + act_shape`. See `store()`
+      reward_tp1: `np.array`, of shape `[n_envs]`. See `store()`
+      done_tp1: `np.array`, of shape `[n_envs]`. See `store()`
+    """
+    assert len(obs_t) == self.n_envs
+
+    lo = self.next_idx
+    hi = lo + self.n_envs
+
+    if self.obs_len > 1:
+      self.obs[lo:hi]   = obs_t[..., -self.obs_shape[-1]:]
+    else:
+      self.obs[lo:hi]   = obs_t
+
+    self.action[lo:hi]  = act_t
+    self.reward[lo:hi]  = rew_tp1
+    self.done[lo:hi]    = done_tp1
+
+    self.next_idx = hi % self.max_size
+    self.size_now = min(self.max_size, self.size_now + self.n_envs)
+    self._n_dirty += self.n_envs
 
 
   def _encode_img_observation(self, idx):
@@ -137,6 +221,53 @@ class BaseBuffer():
       return self.obs[lo:hi].transpose(1, 2, 0, 3).reshape(img_h, img_w, -1)
 
 
+  def _encode_img_observations(self, inds, next_obs=False):
+    """Vectorized version of `_encode_img_observation()` for a whole batch of indices.
+    Builds a `[batch_size, obs_len+1]` matrix of frame indices, which covers the states at both
+    `inds` and `inds+n_envs`. Episode boundaries are handled by remapping the columns of this matrix,
+    so that all frames of all states are gathered with a single fancy-index. Consecutive frames of
+    the same environment are `n_envs` indices apart.
+    NOTE: Used only for image observations. The returned states are channel-last views of the
+    gathered `[batch_size, obs_len] + obs_shape` frames. No copy is made when the frames have a
+    single channel
+    Args:
+      inds: np.array. Indices of the states to encode
+      next_obs: bool. If True, also encode the states at `inds+n_envs`
+    Returns:
+      np.array of shape `[batch_size] + state_shape` or tuple of two such arrays if `next_obs=True`
+    """
+    assert self.obs_len > 1
+
+    inds      = np.asarray(inds, dtype=np.int64)
+    n_frames  = self.obs_len + 1 if next_obs else self.obs_len
+    batch     = len(inds)
+
+    # Buffer indices of all frames that comprise the states; out: [batch_size, n_frames]
+    frame_offs  = np.arange(1-self.obs_len, n_frames-self.obs_len+1) * self.n_envs
+    frame_inds  = (inds[:, None] + frame_offs) % self.max_size
+    done        = self.done[frame_inds]
+
+    samples = np.arange(batch)[:, None]
+    cols    = np.arange(self.obs_len)
+
+    def state_inds(start):
+      # Frames preceding the last episode end in the window are replaced by its first frame
+      ends  = done[:, start:start+self.obs_len-1] * np.arange(1, self.obs_len)
+      lo    = np.max(ends, axis=-1, keepdims=True)
+      return frame_inds[samples, start + np.maximum(cols, lo)]
+
+    starts  = [0, 1] if next_obs else [0]
+    inds    = np.stack([state_inds(start) for start in starts])
+
+    # Gather the frames of all states at once; out: [len(starts), batch_size, obs_len] + obs_shape
+    frames  = self.obs[inds]
+    obs     = [f.transpose(0, 2, 3, 1, 4).reshape([batch] + self.obs_shape[:-1] + [-1]) for f in frames]
+
+    if next_obs:
+      return obs[0], obs[1]
+    return obs[0]
+
+
   def sample(self, batch_size):
     raise NotImplementedError()
 
@@ -172,13 +303,14 @@ class BaseBuffer():
     raise NotImplementedError()
 
 
-  def save(self, model_dir):
-    """Store the data to disk
+  @staticmethod
+  def get_save_dir(model_dir):
+    """Return the directory where the buffer for `model_dir` is saved and create it if needed.
+    If `$RLTFBUF` is defined, the data is stored under it and symlinked in `model_dir`.
     Args:
-      model_dir: Full path of the directory to save the buffer
+      model_dir: Full path of the model directory
     """
-    save_dir    = os.path.join(model_dir, "buffer")
-    state_file  = os.path.join(save_dir, "state.json")
+    save_dir = os.path.join(model_dir, "buffer")
 
     if not os.path.exists(save_dir):
       # Create symlink to store buffer if $RLTFBUF is defined
@@ -198,10 +330,39 @@ class BaseBuffer():
       else:
         os.makedirs(save_dir)
 
-    np.save(os.path.join(save_dir, "obs.npy"),   self.obs[:self.size_now])
-    np.save(os.path.join(save_dir, "act.npy"),   self.action[:self.size_now])
-    np.save(os.path.join(save_dir, "rew.npy"),   self.reward[:self.size_now])
-    np.save(os.path.join(save_dir, "done.npy"),  self.done[:self.size_now])
+    return save_dir
+
+
+  def save(self, model_dir, step=None):
+    """Store the data to disk. The data is split in chunks of `self._chunk_len` transitions and
+    only the chunks modified since the last save are written, so the cost of saving scales with the
+    amount of new data rather than with the buffer size. Modified chunks are written to new files
+    and `state.json` (`state_<step>.json` if `step` is given) serves as a manifest of the current
+    files. The files of older saves are removed only after the manifest is written, so an
+    interrupted save leaves the previous checkpoint intact.
+    If the buffer is memory-mapped in the save directory, the data is only flushed.
+    Args:
+      model_dir: Full path of the directory to save the buffer
+      step: int or None. Agent step of the save. Used to name the manifest
+    """
+    clean = self.snapshot(model_dir, step)()
+    clean()
+
+
+  def snapshot(self, model_dir, step=None):
+    """Copy the data which needs to be saved to memory and return a function which writes it to
+    disk. The function can be run in another thread while the buffer keeps being modified.
+    See `save()` for the on-disk format.
+    Args:
+      model_dir: Full path of the directory to save the buffer
+      step: int or None. Agent step of the save. Used to name the manifest
+    Returns:
+      callable which takes no arguments and performs the disk I/O. It returns a callable which
+      removes the files of older saves. The latter must be called only after the save is committed,
+      e.g. after the agent state which refers to `step` is written
+    """
+    save_dir    = self.get_save_dir(model_dir)
+    state_file  = os.path.join(save_dir, self._save_file("state", ".json", step))
 
     data = {
       "size_now": self.size_now,
@@ -209,19 +370,153 @@ class BaseBuffer():
       # "new_idx":  self.new_idx,
     }
 
-    with atomic_write.atomic_write(state_file) as f:
-      json.dump(data, f, indent=4, sort_keys=True)
+    if self._mmapped_in(save_dir):
+      arrays            = [self.obs, self.action, self.reward, self.done]
+      chunks            = None
+      data["storage"]   = "mmap"
+
+    else:
+      arrays, chunks    = self._snapshot_chunks(save_dir)
+      data["storage"]   = "chunks"
+      data["chunks"]    = chunks
+      data["chunk_len"] = self._chunk_len
+      data["save_id"]   = self._save_id
+
+    def write():
+      try:
+        if chunks is None:
+          for arr in arrays:
+            arr.flush()
+        else:
+          for file, arr in arrays:
+            np.save(file, arr)
+
+        with atomic_write.atomic_write(state_file) as f:
+          json.dump(data, f, indent=4, sort_keys=True)
+
+      except Exception:
+        # The chunks might be missing on disk; write all data on the next save
+        self._saved_dir = None
+        raise
 
+      def clean():
+        if chunks is not None:
+          self._clean_chunks(save_dir, chunks)
+        self._clean_saves(save_dir, "state", ".json", step)
 
-  def restore(self, model_dir):
-    """Populate the buffer from data previously saved to disk
+      return clean
+
+    return write
+
+
+  def _snapshot_chunks(self, save_dir):
+    """Copy the chunks modified since the last save and mark them as saved
+    Returns:
+      tuple `(arrays, chunks)`. `arrays` is a list of `(file, np.array)` to be saved. `chunks` is
+      the list of the save ids of the files holding each chunk
+    """
+    chunk_dir = os.path.join(save_dir, "chunks")
+    if not os.path.exists(chunk_dir):
+      os.makedirs(chunk_dir)
+
+    n_chunks  = -(-self.size_now // self._chunk_len)
+    dirty     = self._dirty_chunks(chunk_dir, n_chunks)
+    chunks    = (self._saved_chunks + [None] * n_chunks)[:n_chunks]
+    arrays    = []
+
+    self._save_id += 1
+
+    for k in dirty:
+      lo, hi = k * self._chunk_len, min((k+1) * self._chunk_len, self.size_now)
+      for name, arr in self._chunk_arrays():
+        arrays.append((self._chunk_file(chunk_dir, name, k, self._save_id), arr[lo:hi].copy()))
+      chunks[k] = self._save_id
+
+    self._saved_chunks  = chunks
+    self._saved_dir     = os.path.realpath(chunk_dir)
+    self._n_dirty       = 0
+
+    return arrays, chunks
+
+
+  def _dirty_chunks(self, chunk_dir, n_chunks):
+    """Return the indices of the chunks which must be written to `chunk_dir`"""
+    # Previous checkpoint in another directory or all transitions overwritten
+    if self._saved_dir != os.path.realpath(chunk_dir) or self._n_dirty >= self.max_size:
+      return list(range(n_chunks))
+
+    # Transitions stored since the last save occupy [next_idx - n_dirty, next_idx) circularly
+    start = (self.next_idx - self._n_dirty) % self.max_size
+    inds  = (start + np.arange(self._n_dirty)) % self.max_size
+    dirty = set(np.unique(inds // self._chunk_len).tolist())
+
+    # Chunks that do not have a file yet
+    dirty.update(k for k in range(n_chunks) if k >= len(self._saved_chunks) or
+                 self._saved_chunks[k] is None)
+
+    return sorted(k for k in dirty if k < n_chunks)
+
+
+  def _clean_chunks(self, save_dir, chunks):
+    """Remove the chunk files which are not part of the manifest `chunks`"""
+    chunk_dir = os.path.join(save_dir, "chunks")
+    keep      = set(os.path.basename(self._chunk_file(chunk_dir, name, k, save_id))
+                    for k, save_id in enumerate(chunks) for name, _ in self._chunk_arrays())
+
+    for file in os.listdir(chunk_dir):
+      if file not in keep:
+        os.remove(os.path.join(chunk_dir, file))
+
+
+  @staticmethod
+  def _save_file(name, ext, step):
+    """Return the name of the file `name` for the save at `step`"""
+    return name + ext if step is None else "%s_%d%s" % (name, step, ext)
+
+
+  @staticmethod
+  def _clean_saves(save_dir, name, ext, step):
+    """Remove all files `name` of saves other than the save at `step`"""
+    pattern = re.compile(r"^%s(_\d+)?%s$" % (re.escape(name), re.escape(ext)))
+    keep    = BaseBuffer._save_file(name, ext, step)
+
+    for file in os.listdir(save_dir):
+      if pattern.match(file) and file != keep:
+        os.remove(os.path.join(save_dir, file))
+
+
+  @staticmethod
+  def _restore_file(save_dir, name, ext, step):
+    """Return the path of the file `name` for the save at `step`. Falls back to the file of a save
+    without a step, e.g. written by an older version"""
+    file = os.path.join(save_dir, BaseBuffer._save_file(name, ext, step))
+    if step is not None and not os.path.exists(file):
+      file = os.path.join(save_dir, name + ext)
+    return file
+
+
+  def _chunk_arrays(self):
+    return [("obs", self.obs), ("act", self.action), ("rew", self.reward), ("done", self.done)]
+
+
+  @staticmethod
+  def _chunk_file(chunk_dir, name, k, save_id):
+    return os.path.join(chunk_dir, "%s_%06d_%06d.npy" % (name, k, save_id))
+
+
+  def restore(self, model_dir, step=None):
+    """Populate the buffer from data previously saved to disk.
+    NOTE: If the buffer is memory-mapped in the save directory, the data is already in place.
+    Any transitions stored after the last save are kept, which can leave a few transitions with
+    inconsistent history around the restored `next_idx`.
     Args:
       model_dir: Full path of the directory of the data
+      step: int or None. Agent step of the save to restore
     """
     save_dir    = os.path.join(model_dir, "buffer")
-    state_file  = os.path.join(save_dir, "state.json")
+    state_file  = self._restore_file(save_dir, "state", ".json", step)
 
-    if not os.path.exists(save_dir):
+    if not os.path.exists(state_file):
       return logger.warning("BaseBuffer not saved and cannot resume. Continuing with empty buffer.")
 
     with open(state_file, 'r') as f:
@@ -231,10 +526,27 @@ class BaseBuffer():
     self.next_idx = data["next_idx"]
     # self.new_idx  = data["new_idx"]
 
-    obs    = np.load(os.path.join(save_dir, "obs.npy"))
-    action = np.load(os.path.join(save_dir, "act.npy"))
-    done   = np.load(os.path.join(save_dir, "done.npy"))
-    reward = np.load(os.path.join(save_dir, "rew.npy"))
+    # Any following save must write all data
+    self._n_dirty   = self.max_size
+    self._saved_dir = None
+
+    storage = data.get("storage", "npy")
+
+    # The memory-mapped files already contain the data
+    if storage == "mmap" and self._mmapped_in(save_dir):
+      return
+
+    if storage == "chunks":
+      return self._restore_chunks(save_dir, data)
+
+    if storage == "mmap":
+      files = [self._mmap_file(save_dir, name) for name in ["obs", "act", "rew", "done"]]
+    else:
+      files = [os.path.join(save_dir, name + ".npy") for name in ["obs", "act", "rew", "done"]]
+
+    # Map the files instead of reading them, so that the data is copied chunk by chunk and no
+    # second full-size copy of the buffer is held in memory
+    obs, action, reward, done = [np.load(file, mmap_mode='r')[:self.size_now] for file in files]
 
     assert len(obs) == len(action) == len(reward) == len(done) == self.size_now
     assert self.obs.shape[1:]     == obs.shape[1:]
@@ -242,45 +554,102 @@ class BaseBuffer():
     assert self.reward.shape[1:]  == reward.shape[1:]
     assert self.done.shape[1:]    == done.shape[1:]
 
-    self.obs[:self.size_now]    = obs
-    self.action[:self.size_now] = action
-    self.reward[:self.size_now] = reward
-    self.done[:self.size_now]   = done
+    self._copy_chunked(self.obs,    obs)
+    self._copy_chunked(self.action, action)
+    self._copy_chunked(self.reward, reward)
+    self._copy_chunked(self.done,   done)
+
+
+  def _restore_chunks(self, save_dir, data):
+    """Reassemble the buffer from the chunk files listed in the manifest `data`"""
+    chunk_dir = os.path.join(save_dir, "chunks")
+    chunk_len = data["chunk_len"]
+    chunks    = data["chunks"]
+
+    assert len(chunks) * chunk_len >= self.size_now
+
+    for k, save_id in enumerate(chunks):
+      lo = k * chunk_len
+      for name, arr in self._chunk_arrays():
+        src = np.load(self._chunk_file(chunk_dir, name, k, save_id), mmap_mode='r')
+        assert arr.shape[1:] == src.shape[1:]
+        arr[lo:lo+len(src)] = src
 
+    # Never reuse the file names of the restored checkpoint
+    self._save_id = data["save_id"]
 
-  def _sample_n_unique(self, n, lo, hi, exclude=None):
-    """Sample n unique indices in the range [lo, hi), making sure no sample appreas in `exclude`
+    # Continue saving incrementally on top of the restored checkpoint
+    if chunk_len == self._chunk_len:
+      self._saved_chunks  = list(chunks)
+      self._saved_dir     = os.path.realpath(chunk_dir)
+      self._n_dirty       = 0
+
+
+  @staticmethod
+  def _copy_chunked(dst, src, chunk_bytes=2**26):
+    """Copy `src` into the beginning of `dst` in chunks of about `chunk_bytes`. When `src` is
+    memory-mapped, only a single chunk of it is paged in by the copy at a time"""
+    row_bytes = max(1, src.itemsize * int(np.prod(src.shape[1:])))
+    chunk     = max(1, chunk_bytes // row_bytes)
+    for i in range(0, len(src), chunk):
+      dst[i:i+chunk] = src[i:i+chunk]
+
+
+  def _mmapped_in(self, save_dir):
+    """Return True if the buffer data is memory-mapped in `save_dir`"""
+    if self.mmap_dir is None:
+      return False
+    return os.path.realpath(self.mmap_dir) == os.path.realpath(save_dir)
+
+
+  def _sample_n_unique(self, n, lo, hi, exclude=None, unique=True):
+    """Sample n indices in the range [lo, hi), making sure no sample appreas in `exclude`.
+    Samples are drawn directly from the valid values: the excluded values are treated as holes in
+    the range and every draw in `[0, n_valid)` is shifted past the holes that precede it. Thus a
+    single vectorized draw always succeeds, no matter where the holes are (e.g. at the circular
+    boundary of the buffer).
     Args:
       n: int. Number of samples to take
       lo: int. Lower boundary of the sample range; inclusive
       hi: int. Upper boundary of the sample range; exclusive
       exclude: list or np.array. Contains values that samples must not take
+      unique: bool. If True, all samples are different. If False, duplicates are allowed, which
+        avoids any redraws for large `n`
     Returns:
       np.array of the sampled indices
     """
 
-    batch = np.empty(n, dtype=np.uint32)
-    k = 0
+    # Sorted holes in the range, expressed as offsets in the range of valid values
+    if exclude is not None:
+      holes = np.unique(np.asarray(exclude, dtype=np.int64))
+      holes = holes[(holes >= lo) & (holes < hi)]
+      holes = holes - lo - np.arange(len(holes))
+    else:
+      holes = np.empty([0], dtype=np.int64)
+
+    n_valid = hi - lo - len(holes)
+    assert n_valid >= n or not unique
 
-    while k < n:
-      samples = self.prng.randint(lo, hi, n-k)
-      # Get only the unique entries
-      samples = np.unique(samples)
-      # Get only the entries which are not in exclude
-      if exclude is not None:
-        valid = np.all(samples[:, None] != exclude, axis=-1)
-        samples = samples[valid]
-      # Update batch
-      end = min(k + samples.shape[0], n)
-      batch[k:end] = samples
-      k = end
+    # Sample offsets in the range of valid values
+    if not unique:
+      samples = self.prng.randint(0, n_valid, n)
+    elif 2 * n > n_valid:
+      samples = self.prng.choice(n_valid, n, replace=False)
+    else:
+      # Duplicates are rare, so only redraw as many as needed
+      samples = np.unique(self.prng.randint(0, n_valid, n))
+      while len(samples) < n:
+        samples = np.concatenate([samples, self.prng.randint(0, n_valid, n - len(samples))])
+        samples = np.unique(samples)
 
-    return batch
+    # Map the offsets to the actual values by skipping all holes up to the offset
+    return samples + lo + np.searchsorted(holes, samples, side="right")
 
 
   def reset(self):
     self.size_now   = 0
     self.next_idx   = 0
+    self._n_dirty   = self.max_size
     # self.new_idx    = 0
 
 
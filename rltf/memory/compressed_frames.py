@@ -0,0 +1,121 @@
+import os
+import zlib
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CompressedFrames:
+  """Fixed-size array of image frames, where every frame is compressed separately. Supports the
+  subset of the `np.array` interface used by `BaseBuffer` for `obs`: item and slice assignment,
+  indexing with ints, slices and index arrays, `np.take()` and the `shape` and `dtype` attributes.
+  Reading returns decompressed `np.array`s. Batches of frames are decompressed in a thread pool.
+  Both zlib and lz4 release the GIL while decompressing, so the threads run in parallel.
+  """
+
+  def __init__(self, size, frame_shape, dtype, codec="zlib", n_threads=None):
+    """
+    Args:
+      size: int. Number of frames
+      frame_shape: list. Shape of a single frame
+      dtype: np.dtype. Type of the frame data
+      codec: str. Either "zlib" or "lz4". "lz4" requires the `lz4` package and decompresses faster
+      n_threads: int or None. Number of threads used to decompress a batch of frames. If None,
+        at most 4, depending on the number of CPUs
+    """
+    self.shape        = tuple([size] + list(frame_shape))
+    self.dtype        = np.dtype(dtype)
+    self.frame_shape  = tuple(frame_shape)
+
+    if codec == "zlib":
+      self._compress    = lambda data: zlib.compress(data, 1)
+      self._decompress  = zlib.decompress
+    elif codec == "lz4":
+      import lz4.frame #pylint: disable=import-outside-toplevel
+      self._compress    = lz4.frame.compress
+      self._decompress  = lz4.frame.decompress
+    else:
+      raise ValueError("Unknown compression codec '{}'".format(codec))
+
+    # Frames which were never written read as zeros. They all share the same compressed data
+    self._frames    = np.empty([size], dtype=object)
+    self._frames.fill(self._compress_frame(np.zeros(self.frame_shape, dtype=self.dtype)))
+
+    self._n_threads = n_threads if n_threads is not None else min(4, os.cpu_count() or 1)
+    self._pool      = None
+
+
+  def __len__(self):
+    return self.shape[0]
+
+
+  def __setitem__(self, i, data):
+    if isinstance(i, slice):
+      for j, frame in zip(range(*i.indices(len(self))), data):
+        self._frames[j] = self._compress_frame(frame)
+    else:
+      self._frames[i] = self._compress_frame(data)
+
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return self.take(np.arange(*i.indices(len(self))))
+    if np.ndim(i) == 0:
+      return self._decompress_frame(self._frames[i])
+    return self.take(i)
+
+
+  def take(self, indices, axis=0, out=None, mode="raise"): #pylint: disable=unused-argument
+    """Decompress the frames at `indices`. Called by `np.take()`
+    Args:
+      indices: np.array of int. Frame indices of any shape
+      axis: int. Must be 0
+      out: np.array or None. If provided, the frames are written to it
+      mode: str. Ignored. Indices must be in range
+    Returns:
+      np.array of shape `indices.shape + frame_shape`
+    """
+    assert axis == 0
+    indices = np.asarray(indices, dtype=np.int64)
+    if out is None:
+      out = np.empty(indices.shape + self.frame_shape, dtype=self.dtype)
+
+    flat  = out.reshape((-1,) + self.frame_shape)
+    inds  = indices.ravel()
+
+    # Each frame is decompressed only once, even if it is part of several states
+    uinds, where = np.unique(inds, return_inverse=True)
+    frames = np.empty((len(uinds),) + self.frame_shape, dtype=self.dtype)
+
+    def decompress(lo, hi):
+      data = b"".join([self._decompress(frame) for frame in self._frames[uinds[lo:hi]]])
+      frames[lo:hi] = np.frombuffer(data, dtype=self.dtype).reshape(frames[lo:hi].shape)
+
+    n_threads = min(self._n_threads, len(uinds))
+    if n_threads > 1:
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(self._n_threads, thread_name_prefix="decompress")
+      bounds  = np.linspace(0, len(uinds), n_threads + 1).astype(np.int64)
+      futures = [self._pool.submit(decompress, lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+      for future in futures:
+        future.result()
+    else:
+      decompress(0, len(uinds))
+
+    flat[:] = frames[where.ravel()]
+    return out
+
+
+  def nbytes_compressed(self):
+    """Return the total size of the compressed frames in bytes"""
+    return sum(len(frame) for frame in self._frames)
+
+
+  def _compress_frame(self, frame):
+    frame = np.ascontiguousarray(frame, dtype=self.dtype)
+    assert frame.shape == self.frame_shape
+    return self._compress(frame.tobytes())
+
+
+  def _decompress_frame(self, data):
+    return np.frombuffer(self._decompress(data), dtype=self.dtype).reshape(self.frame_shape)
@@ -86,14 +86,11 @@ class PGBuffer(BaseBuffer):
     assert self.next_idx == 0
 
     self.next_vf[-1] = next_vf
-    gae_t = 0
 
     # Compute GAE(gamma, lambda)
-    # pylint: disable=redefined-argument-from-local
-    for t, (_, _, rew, done, vf, next_vf) in zip(reversed(range(self.size_now)), reversed(self)):
-      delta_t = rew + (1 - done) * gamma * next_vf  - vf
-      gae_t   = delta_t + (1 - done) * gamma * lam * gae_t
-      self.gae_lambda[t] = gae_t
+    n = self.size_now
+    self.gae_lambda[:n] = compute_gae(self.reward[:n], self.done[:n], self.vf[:n], self.next_vf[:n],
+                                      gamma, lam)
 
     # Compute TD(lambda)
     self.td_lambda = self.gae_lambda + self.vf
@@ -129,7 +126,7 @@ class PGBuffer(BaseBuffer):
     if self.obs_len == 1:
       obs_batch     = self.obs[inds]
     else:
-      obs_batch     = np.concatenate([self._encode_img_observation(idx)[None] for idx in inds], 0)
+      obs_batch     = self._encode_img_observations(inds)
 
     act_batch   = self.action[inds]
     gae_batch   = self.gae_lambda[inds]
@@ -138,3 +135,33 @@ class PGBuffer(BaseBuffer):
     vf_batch    = self.vf[inds]
 
     return dict(obs=obs_batch, act=act_batch, adv=gae_batch, ret=td_batch, logp=logp_batch, vf=vf_batch)
+
+
+
+def compute_gae(rew, done, vf, next_vf, gamma, lam):
+  """Compute the GAE(gamma, lambda) advantage estimates for one or more rollouts, without a Python
+  loop over time. The recursion `gae_t = delta_t + c_t * gae_{t+1}`, with `c_t = (1-done_t)*gamma*lam`,
+  is solved with a reverse parallel scan in `ceil(log2(T))` vectorized steps. The coefficients are
+  only multiplied together, so the result is numerically stable for arbitrarily long rollouts.
+  Args:
+    rew: np.array, shape=[..., T]. Rewards. Leading dimensions index different rollouts, e.g. envs
+    done: np.array, shape=[..., T]. Episode termination flags
+    vf: np.array, shape=[..., T]. Value function estimates for each step
+    next_vf: np.array, shape=[..., T]. Value function estimates for the next step of each step
+    gamma: float. The value of gamma for GAE(gamma, lambda)
+    lam: float. The value of lambda for GAE(gamma, lambda)
+  Returns:
+    np.array of shape `[..., T]` and dtype np.float32
+  """
+  notdone = 1.0 - np.asarray(done, dtype=np.float64)
+  gae     = rew + notdone * gamma * next_vf - vf
+  coef    = notdone * (gamma * lam)
+
+  # After the step with shift k, gae[t] sums the terms delta_t..delta_{t+2k-1}
+  k = 1
+  while k < gae.shape[-1]:
+    gae[..., :-k]   = gae[..., :-k] + coef[..., :-k] * gae[..., k:]
+    coef[..., :-k]  = coef[..., :-k] * coef[..., k:]
+    k *= 2
+
+  return gae.astype(np.float32)
@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchPrefetcher:
+  """Samples training batches from a `ReplayBuffer` in background threads and keeps them in a
+  bounded queue, so that the next batch is ready as soon as the current training step finishes.
+
+  A batch can be sampled while the environment thread stores several new transitions. To keep the
+  batches consistent, the excluded window of the buffer is extended by `lookahead` indices for as
+  long as the prefetcher is running. See `ReplayBuffer._exclude_indices()`.
+
+  NOTE: Prefetching changes the points in time at which batches are sampled relative to `store()`.
+  It must not be used with a buffer in deterministic `sync` mode.
+  """
+
+  def __init__(self, buffer, batch_size, n_workers=1, queue_size=2, lookahead=16):
+    """
+    Args:
+      buffer: rltf.memory.ReplayBuffer. The buffer to sample from
+      batch_size: int. Size of a single batch
+      n_workers: int. Number of sampling threads
+      queue_size: int. Maximum number of batches kept ready
+      lookahead: int. Maximum number of transitions which can be stored while a batch is sampled
+    """
+    assert n_workers >= 1
+    assert queue_size >= 1
+    assert not buffer.sync, "Prefetching is not supported for a buffer in sync mode"
+
+    self.buffer     = buffer
+    self.batch_size = batch_size
+    self.n_workers  = n_workers
+    self.lookahead  = lookahead
+
+    self._queue     = queue.Queue(maxsize=queue_size)
+    self._stop      = threading.Event()
+    self._threads   = []
+    self._lookahead = None   # Buffer lookahead before the prefetcher was started
+
+
+  def start(self):
+    """Start the sampling threads"""
+    if self._threads:
+      return
+
+    self._lookahead       = self.buffer.lookahead
+    self.buffer.lookahead = max(self.buffer.lookahead, self.lookahead)
+    self._stop.clear()
+
+    for i in range(self.n_workers):
+      t = threading.Thread(name="prefetch_thread_%d" % i, target=self._run, daemon=True)
+      t.start()
+      self._threads.append(t)
+
+
+  def get(self):
+    """Return the next prefetched batch. Blocks until one is available
+    Returns:
+      dict, as returned by `ReplayBuffer.sample()`
+    """
+    batch = self._queue.get()
+    if isinstance(batch, Exception):
+      raise batch
+    return batch
+
+
+  def stop(self):
+    """Stop the sampling threads and drop any prefetched batches"""
+    self._stop.set()
+
+    # Unblock workers waiting to put a batch
+    while any(t.is_alive() for t in self._threads):
+      self._drain()
+      for t in self._threads:
+        t.join(timeout=0.01)
+    self._drain()
+
+    self._threads = []
+    if self._lookahead is not None:
+      self.buffer.lookahead = self._lookahead
+      self._lookahead       = None
+
+
+  def _run(self):
+    while not self._stop.is_set():
+      try:
+        batch = self.buffer.sample(self.batch_size)
+      except Exception as e: #pylint: disable=broad-except
+        logger.exception("Prefetching a batch failed")
+        self._put(e)
+        return
+      self._put(batch)
+
+
+  def _put(self, item):
+    # Retry with a timeout in order to notice stop() while the queue is full
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+
+  def _drain(self):
+    while True:
+      try:
+        self._queue.get_nowait()
+      except queue.Empty:
+        return
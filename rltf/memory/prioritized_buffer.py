@@ -0,0 +1,233 @@
+import logging
+import os
+import threading
+import numpy as np
+
+from rltf.memory              import BaseBuffer
+from rltf.memory              import ReplayBuffer
+from rltf.memory.segment_tree import MinTree
+from rltf.memory.segment_tree import SumTree
+
+
+logger = logging.getLogger(__name__)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+  """Proportional Prioritized Experience Replay buffer (Schaul et. al. 2016). Transitions are sampled
+  with probability proportional to `priority**alpha`. The priorities are kept in an array-based
+  sum-tree and min-tree, so both sampling and priority updates cost `O(log n)` vectorized operations.
+  Follows the same thread-safety contract as `ReplayBuffer`: `sample()` never returns indices from
+  `_exclude_indices()`, which allows another thread to concurrently call `store()`.
+  """
+
+  def __init__(self, size, state_shape, obs_dtype, act_shape, act_dtype, obs_len=1, sync=False,
+               mmap_dir=None, compress=None, n_envs=1, alpha=0.6, beta=0.4, eps=1e-6):
+    """
+    Args: `See ReplayBuffer.__init__()`
+      alpha: float, `>= 0`. Prioritization exponent. `alpha=0` corresponds to uniform sampling
+      beta: float, `>= 0`. Default importance sampling exponent. Can be overriden in `sample()`
+      eps: float. Small constant added to priorities in `update_priorities()` to keep them positive
+    """
+
+    super().__init__(size, state_shape, obs_dtype, act_shape, act_dtype, obs_len, sync, mmap_dir,
+                     compress, n_envs)
+
+    assert alpha >= 0
+    assert beta  >= 0
+
+    self.alpha      = alpha
+    self.beta       = beta
+    self.eps        = eps
+
+    self._it_sum    = SumTree(self.max_size)
+    self._it_min    = MinTree(self.max_size)
+    self._max_prio  = 1.0
+
+    # Tree updates touch shared ancestor nodes and must not interleave
+    self._tree_lock = threading.Lock()
+
+
+  def store(self, obs_t, act_t, rew_tp1, done_tp1):
+    """See `BaseBuffer.store()`. New transitions get the maximum priority seen so far"""
+
+    self.wait_sampled()
+
+    with self._tree_lock:
+      prio = self._max_prio ** self.alpha
+      self._it_sum.update(self.next_idx, prio)
+      self._it_min.update(self.next_idx, prio)
+
+    BaseBuffer.store(self, obs_t, act_t, rew_tp1, done_tp1)
+
+    self.signal_stored()
+
+
+  def store_batch(self, obs_t, act_t, rew_tp1, done_tp1):
+    """See `BaseBuffer.store_batch()`. New transitions get the maximum priority seen so far"""
+
+    self.wait_sampled()
+
+    with self._tree_lock:
+      inds = (self.next_idx + np.arange(self.n_envs)) % self.max_size
+      prio = self._max_prio ** self.alpha
+      self._it_sum.update(inds, prio)
+      self._it_min.update(inds, prio)
+
+    BaseBuffer.store_batch(self, obs_t, act_t, rew_tp1, done_tp1)
+
+    self.signal_stored()
+
+
+  def sample(self, batch_size, beta=None):
+    """Sample `batch_size` transitions proportionally to their priorities. Uses stratified
+    sampling: the total priority mass is split in `batch_size` equal segments and one transition
+    is drawn from each segment. Samples are not guaranteed to be unique.
+
+    Args:
+      batch_size: int. Size of the batch to sample
+      beta: float or None. Importance sampling exponent. If None, `self.beta` is used
+    Returns:
+      Python dictionary with the same keys as `ReplayBuffer.sample()` and additionally
+      "weight": np.array, shape=[batch_size], dtype=np.float32. Importance sampling weights,
+        normalized by the maximum possible weight
+      "inds": np.array, shape=[batch_size], dtype=np.int64. Buffer indices of the samples. Should be
+        passed to `update_priorities()` together with the new priorities
+    """
+    beta = self.beta if beta is None else beta
+
+    self.wait_stored()
+    exclude = self._exclude_indices()
+    self.signal_sampled()
+
+    assert batch_size < self.size_now - len(exclude) - 1
+
+    with self._tree_lock:
+      inds    = self._sample_proportional(batch_size, exclude)
+      weights = self._compute_weights(inds, beta)
+
+    samples = self._batch_samples(inds)
+    samples["weight"] = weights
+    samples["inds"]   = inds
+
+    return samples
+
+
+  def update_priorities(self, inds, prios):
+    """Update the priorities of sampled transitions
+    Args:
+      inds: np.array. Buffer indices, as returned by `sample()`
+      prios: np.array. New priorities for each index, e.g. the absolute TD errors. Must be `>= 0`
+    """
+    prios = np.abs(np.asarray(prios, dtype=np.float64)) + self.eps
+    assert len(inds) == len(prios)
+
+    with self._tree_lock:
+      self._it_sum.update(inds, prios ** self.alpha)
+      self._it_min.update(inds, prios ** self.alpha)
+      self._max_prio = max(self._max_prio, np.max(prios))
+
+
+  def _sample_proportional(self, n, exclude, max_tries=16):
+    """Sample n indices proportionally to their priorities, making sure no sample is in `exclude`.
+    Samples which fall in the excluded window or out of the valid range are redrawn from their own
+    segment of the priority mass, so the batch stays stratified. Samples which are still invalid
+    after `max_tries` redraws, e.g. because their whole segment is excluded, are redrawn from the
+    whole priority mass. Must be called while holding `self._tree_lock`
+    Returns:
+      np.array of the sampled indices
+    """
+    total   = self._it_sum.reduce()
+    segment = total / n
+    strata  = np.arange(n)
+    inds    = self._it_sum.find_prefixsum_idx((strata + self.prng.uniform(size=n)) * segment)
+
+    # Redraw the few samples which fall in the excluded window or out of the valid range
+    invalid = self._invalid_indices(inds, exclude)
+    for _ in range(max_tries):
+      if not np.any(invalid):
+        return inds
+      k     = np.count_nonzero(invalid)
+      mass  = (strata[invalid] + self.prng.uniform(size=k)) * segment
+      inds[invalid] = self._it_sum.find_prefixsum_idx(mass)
+      invalid = self._invalid_indices(inds, exclude)
+
+    while np.any(invalid):
+      k = np.count_nonzero(invalid)
+      inds[invalid] = self._it_sum.find_prefixsum_idx(self.prng.uniform(0, total, size=k))
+      invalid = self._invalid_indices(inds, exclude)
+
+    return inds
+
+
+  def _invalid_indices(self, inds, exclude):
+    return (inds >= self.size_now) | np.isin(inds, exclude)
+
+
+  def _compute_weights(self, inds, beta):
+    """Compute the normalized importance sampling weights `(N * P(i))**(-beta) / max_j w_j`.
+    Must be called while holding `self._tree_lock`"""
+    total   = self._it_sum.reduce()
+    p_min   = self._it_min.reduce() / total
+    p       = self._it_sum[inds] / total
+
+    max_w   = (p_min * self.size_now) ** (-beta)
+    weights = (p * self.size_now) ** (-beta) / max_w
+
+    return weights.astype(np.float32)
+
+
+  def snapshot(self, model_dir, step=None):
+    """Copy the data and the priorities to be saved. See `BaseBuffer.snapshot()`"""
+    write_data  = super().snapshot(model_dir, step)
+    save_dir    = os.path.join(model_dir, "buffer")
+    prio_file   = os.path.join(save_dir, self._save_file("prio", ".npy", step))
+
+    with self._tree_lock:
+      prios = self._it_sum[np.arange(self.size_now)]
+
+    def write():
+      clean_data = write_data()
+      np.save(prio_file, prios)
+
+      def clean():
+        clean_data()
+        self._clean_saves(save_dir, "prio", ".npy", step)
+
+      return clean
+
+    return write
+
+
+  def restore(self, model_dir, step=None):
+    """Populate the buffer and the priorities from data previously saved to disk.
+    If no priorities were saved, all restored transitions get priority 1"""
+    super().restore(model_dir, step)
+
+    if self.size_now == 0:
+      return
+
+    prio_file = self._restore_file(os.path.join(model_dir, "buffer"), "prio", ".npy", step)
+
+    if os.path.exists(prio_file):
+      prios = np.load(prio_file)
+      assert len(prios) == self.size_now
+    else:
+      logger.warning("Buffer priorities not saved. Restoring with uniform priorities.")
+      prios = np.ones([self.size_now], dtype=np.float64)
+
+    with self._tree_lock:
+      self._it_sum.reset()
+      self._it_min.reset()
+      self._it_sum.update(np.arange(self.size_now), prios)
+      self._it_min.update(np.arange(self.size_now), prios)
+      # Saved priorities already have the alpha exponent applied
+      if self.alpha > 0:
+        self._max_prio = max(1.0, np.max(prios) ** (1.0 / self.alpha))
+
+
+  def reset(self):
+    super().reset()
+    with self._tree_lock:
+      self._it_sum.reset()
+      self._it_min.reset()
+      self._max_prio = 1.0
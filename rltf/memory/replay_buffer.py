@@ -10,12 +10,19 @@ class ReplayBuffer(BaseBuffer):
   observations
   """
 
-  def __init__(self, size, state_shape, obs_dtype, act_shape, act_dtype, obs_len=1, sync=False):
+  def __init__(self, size, state_shape, obs_dtype, act_shape, act_dtype, obs_len=1, sync=False,
+               mmap_dir=None, compress=None, n_envs=1):
     """
     Args: `See BaseBuffer.__init__()`
+      n_envs: int. Number of environments which store data in lockstep via `store_batch()`.
+        `size` is rounded down to a multiple of `n_envs`
     """
 
-    super().__init__(size, state_shape, obs_dtype, act_shape, act_dtype, obs_len)
+    size = int(size) // n_envs * n_envs
+
+    super().__init__(size, state_shape, obs_dtype, act_shape, act_dtype, obs_len, mmap_dir, compress)
+
+    self.n_envs   = n_envs
 
     self._sync    = sync and seeding.SEEDED
     self._sampled = threading.Event()
@@ -23,6 +30,9 @@ class ReplayBuffer(BaseBuffer):
     self._sampled.clear()
     self._stored.set()
 
+    # Number of additional calls to `store()` which can happen while a batch is being sampled
+    self.lookahead = 0
+
 
   def store(self, obs_t, act_t, rew_tp1, done_tp1):
     """See `BaseBuffer.store()`"""
@@ -34,7 +44,17 @@ class ReplayBuffer(BaseBuffer):
     self.signal_stored()
 
 
-  def sample(self, batch_size):
+  def store_batch(self, obs_t, act_t, rew_tp1, done_tp1):
+    """See `BaseBuffer.store_batch()`"""
+
+    self.wait_sampled()
+
+    super().store_batch(obs_t, act_t, rew_tp1, done_tp1)
+
+    self.signal_stored()
+
+
+  def sample(self, batch_size, unique=True):
     """
     Sample uniformly `batch_size` different transitions. Note that the
     implementation is thread-safe and allows for another thread to be currently
@@ -47,6 +67,7 @@ class ReplayBuffer(BaseBuffer):
 
     Args:
       batch_size: int. Size of the batch to sample
+      unique: bool. If False, the batch might contain duplicate transitions. Cheaper for big batches
     Returns:
       Python dictionary with keys
       "obs": np.array, shape=[batch_size, state_shape], dtype=obs_dtype, Batch states
@@ -63,7 +84,7 @@ class ReplayBuffer(BaseBuffer):
 
     assert batch_size < self.size_now - len(exclude) - 1
 
-    inds    = self._sample_n_unique(batch_size, 0, self.size_now, exclude)
+    inds    = self._sample_n_unique(batch_size, 0, self.size_now, exclude, unique)
     samples = self._batch_samples(inds)
 
     return samples
@@ -76,13 +97,12 @@ class ReplayBuffer(BaseBuffer):
     Returns:
       See self.sample()
     """
-    next_inds = (inds+1) % self.max_size
+    next_inds = (inds+self.n_envs) % self.max_size
     if self.obs_len == 1:
       obs_batch     = self.obs[inds]
       obs_tp1_batch = self.obs[next_inds]
     else:
-      obs_batch     = np.concatenate([self._encode_img_observation(idx)[None] for idx in inds], 0)
-      obs_tp1_batch = np.concatenate([self._encode_img_observation(idx)[None] for idx in next_inds], 0)
+      obs_batch, obs_tp1_batch = self._encode_img_observations(inds, next_obs=True)
 
     act_batch = self.action[inds]
     rew_batch = self.reward[inds]
@@ -109,12 +129,22 @@ class ReplayBuffer(BaseBuffer):
     # If self.sync == True, then `store()` has not begun and the upper bound is idx+obs_len-1
     # NOTE: QlearnAgent can call `store()` only once before `sample()` finishes. If it calls
     # `sample()` twice, before `store()` finishes, nothing changes.
+    # If `self.lookahead` more stores can happen while the batch is being sampled (e.g. when batches
+    # are prefetched in another thread), the upper bound is shifted by the same amount.
+    # If `n_envs > 1`, all of the above holds for the whole group of `n_envs` interleaved transitions.
 
+    n       = self.n_envs
     idx     = self.next_idx
-    exclude = np.arange(idx-1, idx+self.obs_len) % self.max_size
+    exclude = np.arange(idx-n, idx+n*self.obs_len+self.lookahead) % self.max_size
     return exclude
 
 
+  @property
+  def sync(self):
+    """True if `store()` and `sample()` are synchronized for deterministic execution"""
+    return self._sync
+
+
   def wait_sampled(self):
     if not self._sync:
       return
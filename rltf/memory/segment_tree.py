@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class SegmentTree:
+  """Array-based binary segment tree over a fixed number of leaves. All operations are vectorized
+  over batches of indices and take `O(log n)` NumPy calls, independent of the batch size.
+  The tree is stored in a flat array, where node `i` has children `2*i` and `2*i+1`, the root is
+  at index 1 and the leaves start at index `capacity`.
+  """
+
+  def __init__(self, size, op, neutral):
+    """
+    Args:
+      size: int. Number of leaves. Rounded up to the next power of 2 internally
+      op: np.ufunc. Associative binary operation used to reduce two children, e.g. `np.add`
+      neutral: float. Neutral element of `op`. All leaves are initialized to it
+    """
+    assert size > 0
+
+    self.depth    = int(np.ceil(np.log2(size))) if size > 1 else 0
+    self.capacity = 2 ** self.depth
+    self.size     = size
+    self.op       = op
+    self.neutral  = neutral
+    self.tree     = np.full([2 * self.capacity], neutral, dtype=np.float64)
+
+
+  def update(self, inds, values):
+    """Set the values of the leaves at `inds` and update all their ancestors
+    Args:
+      inds: np.array or int. Leaf indices
+      values: np.array or float. New leaf values. Must be broadcastable to the shape of `inds`
+    """
+    nodes = np.atleast_1d(np.asarray(inds, dtype=np.int64)) + self.capacity
+    self.tree[nodes] = values
+
+    # Duplicate nodes are harmless - they are all assigned the same value
+    for _ in range(self.depth):
+      nodes = nodes // 2
+      self.tree[nodes] = self.op(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+
+  def reduce(self):
+    """Return the result of applying `op` over all leaves"""
+    return self.tree[1]
+
+
+  def reset(self):
+    self.tree[:] = self.neutral
+
+
+  def __getitem__(self, inds):
+    return self.tree[np.asarray(inds, dtype=np.int64) + self.capacity]
+
+
+
+class SumTree(SegmentTree):
+
+  def __init__(self, size):
+    super().__init__(size, np.add, 0.0)
+
+
+  def find_prefixsum_idx(self, mass):
+    """For each value in `mass`, find the highest leaf index `i` such that the sum of leaves
+    `[0, i)` is less than or equal to the value. Descends all values down the tree at once.
+    Args:
+      mass: np.array. Values in the range `[0, self.reduce())`
+    Returns:
+      np.array of leaf indices with the same shape as `mass`
+    """
+    mass  = np.array(mass, dtype=np.float64)
+    nodes = np.ones(mass.shape, dtype=np.int64)
+
+    for _ in range(self.depth):
+      left      = 2 * nodes
+      left_sum  = self.tree[left]
+      right     = mass >= left_sum
+      mass      = mass - left_sum * right
+      nodes     = left + right
+
+    return nodes - self.capacity
+
+
+
+class MinTree(SegmentTree):
+
+  def __init__(self, size):
+    super().__init__(size, np.minimum, np.inf)
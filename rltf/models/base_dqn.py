@@ -23,26 +23,38 @@ class BaseQlearn(Model):
     self.update_target  = None  # Optional
 
 
-  def _build_ph(self):
-    """Build the input placehodlers"""
+  def _build_ph(self, obs_tp1_default=False):
+    """Build the input placehodlers
+    Args:
+      obs_tp1_default: bool. If True, `obs_tp1_ph` defaults to an empty batch and does not have to
+        be fed when only tensors which depend on `obs_t_ph` are run
+    """
     self.obs_t_ph   = tf.placeholder(self.obs_dtype,  [None] + self.obs_shape, name="obs_t_ph")
     self.act_t_ph   = tf.placeholder(self.act_dtype,  [None] + self.act_shape, name="act_t_ph")
     self.rew_t_ph   = tf.placeholder(tf.float32,      [None],                  name="rew_t_ph")
-    self.obs_tp1_ph = tf.placeholder(self.obs_dtype,  [None] + self.obs_shape, name="obs_tp1_ph")
     self.done_ph    = tf.placeholder(tf.bool,         [None],                  name="done_ph")
 
+    if obs_tp1_default:
+      empty_obs       = tf.zeros([0] + self.obs_shape, dtype=self.obs_dtype)
+      self.obs_tp1_ph = tf.placeholder_with_default(empty_obs, [None] + self.obs_shape, name="obs_tp1_ph")
+    else:
+      self.obs_tp1_ph = tf.placeholder(self.obs_dtype, [None] + self.obs_shape, name="obs_tp1_ph")
+
 
 
 class BaseDQN(BaseQlearn):
   """Abstract DQN class"""
 
-  def __init__(self, obs_shape, n_actions, opt_conf, gamma):
+  def __init__(self, obs_shape, n_actions, opt_conf, gamma, single_pass=False):
     """
     Args:
       obs_shape: list. Shape of the observation tensor
       n_actions: int. Number of possible actions
       opt_conf: rltf.optimizers.OptimizerConf. Configuration for the optimizer
       gamma: float. Discount factor
+      single_pass: bool. If True, `obs_t` and `obs_tp1` are concatenated and passed through the
+        agent network as a single batch. Saves a separate pass for models which use the agent
+        network output for `obs_tp1`, e.g. Double DQN. See `self._agent_net_tp1()`
     """
 
     assert len(obs_shape) == 3 or len(obs_shape) == 1
@@ -57,23 +69,30 @@ class BaseDQN(BaseQlearn):
     self.act_dtype  = tf.uint8
     self.act_shape  = []
     self.n_actions  = n_actions
+    self.single_pass = single_pass
 
     # Custom TF Tensors and Ops
     self.obs_t      = None
     self.obs_tp1    = None
+    self._agent_tp1 = None    # Output of the agent network for obs_tp1 if self.single_pass
 
 
   def build(self):
 
-    # Build the input placeholders
-    self._build_ph()
+    # Build the input placeholders. With a single pass, obs_tp1 is not needed to select actions
+    self._build_ph(obs_tp1_default=self.single_pass)
 
     # Preprocess the observation
     self.obs_t    = tf_utils.preprocess_input(self.obs_t_ph)
     self.obs_tp1  = tf_utils.preprocess_input(self.obs_tp1_ph)
 
     # Construct the Q-network and the target network
-    agent_net     = self._nn_model(self.obs_t,   scope="agent_net")
+    if self.single_pass:
+      obs         = tf.concat([self.obs_t, self.obs_tp1], axis=0)
+      agent_out   = self._nn_model(obs, scope="agent_net")
+      agent_net, self._agent_tp1 = self._split_batch(agent_out)
+    else:
+      agent_net   = self._nn_model(self.obs_t,   scope="agent_net")
     target_net    = self._nn_model(self.obs_tp1, scope="target_net")
 
     # Compute the estimated Q-function and its backup value
@@ -111,6 +130,23 @@ class BaseDQN(BaseQlearn):
         return self._dense_nn(x)
 
 
+  def _agent_net_tp1(self):
+    """Return the output of the agent network for `obs_tp1`. If `self.single_pass`, the output is
+    part of the single agent network pass. Otherwise, a new pass is built"""
+    if self.single_pass:
+      return self._agent_tp1
+    return self._nn_model(self.obs_tp1, scope="agent_net")
+
+
+  def _split_batch(self, x):
+    """Split a tensor computed from the concatenated `obs_t` and `obs_tp1` into the two parts.
+    Returns:
+      Tuple of `tf.Tensor`s for `obs_t` and `obs_tp1`
+    """
+    n = tf.shape(self.obs_t)[0]
+    return x[:n], x[n:]
+
+
   def _conv_nn(self, x):
     raise NotImplementedError()
 
@@ -167,8 +203,16 @@ class BaseDQN(BaseQlearn):
 
 
   def action_train_ops(self, sess, state, run_dict=None):
-    return super()._action_train_ops(sess, run_dict, feed_dict={self.obs_t_ph: state[None,:]})
+    return self.batch_action_train_ops(sess, state[None,:], run_dict)
+
+
+  def batch_action_train_ops(self, sess, states, run_dict=None):
+    return super()._action_train_ops(sess, run_dict, feed_dict={self.obs_t_ph: states})
 
 
   def action_eval_ops(self, sess, state, run_dict=None):
-    return super()._action_eval_ops(sess, run_dict, feed_dict={self.obs_t_ph: state[None,:]})
+    return self.batch_action_eval_ops(sess, state[None,:], run_dict)
+
+
+  def batch_action_eval_ops(self, sess, states, run_dict=None):
+    return super()._action_eval_ops(sess, run_dict, feed_dict={self.obs_t_ph: states})
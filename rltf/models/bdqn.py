@@ -1,7 +1,7 @@
 import tensorflow as tf
 
 from rltf.models      import DDQN
-from rltf.tf_utils    import BLR, tf_utils
+from rltf.tf_utils    import BatchedBLR, tf_utils
 
 
 class BDQN(DDQN):
@@ -21,20 +21,23 @@ class BDQN(DDQN):
 
     super().__init__(**kwargs)
 
-    self.agent_blr  = [BLR(tau=tau, sigma_e=sigma_e, mode=mode)   for _ in range(self.n_actions)]
-    self.target_blr = [BLR(tau=tau, sigma_e=sigma_e, mode="mean") for _ in range(self.n_actions)]
+    # A single batch of BLR models, one for each action
+    self.agent_blr  = BatchedBLR(tau=tau, sigma_e=sigma_e, n_outputs=self.n_actions, mode=mode)
+    self.target_blr = BatchedBLR(tau=tau, sigma_e=sigma_e, n_outputs=self.n_actions, mode="mean")
 
     # Custom TF Tensors and Ops
     self._target    = None    # BLR target
     self._phi       = None    # BLR features
     self.train_blr  = None    # Op for updating the BLR weight posterior
+    self.accum_blr  = None    # Op for accumulating a batch of BLR training data
+    self.update_blr = None    # Op for updating the BLR weight posterior from the accumulated data
     self.reset_blr  = None    # Op for reseting the BLR to initial weights
     self.a_var      = None    # Tensor with BLR var
 
 
   def build(self):
     super().build()
-    self.reset_blr = tf.group(*[blr.reset_op for blr in self.agent_blr], name="reset_blr")
+    self.reset_blr = tf.group(self.agent_blr.reset_op, name="reset_blr")
 
 
   def _conv_nn(self, x):
@@ -55,17 +58,19 @@ class BDQN(DDQN):
       # Normalize features
       # if self.phi_norm:
       #   x = tf.layers.batch_normalization(phi, axis=-1, training=tf.not_equal(tf.shape(x)[0], 1))
-      blrs = self.agent_blr if "agent_net" in tf.get_variable_scope().name else self.target_blr
+      blr = self.agent_blr if "agent_net" in tf.get_variable_scope().name else self.target_blr
 
-      # Compute the mean and std prediction from BLR
-      blr_out = [blr.apply(x) for blr in blrs]
+      # Compute the mean and std prediction from BLR for all actions
+      mean, var = blr.apply(x)
       # Remember phi and the stds
       if "agent_net" in tf.get_variable_scope().name and self._phi is None:
         self._phi  = x
-        self.a_var = tf.concat([var for (_, var) in blr_out], axis=-1)
-      # Group the mean predictions
-      x = [mean for (mean, _) in blr_out]
-      x = tf.concat(x, axis=-1)
+        self.a_var = var
+        # With a single pass, keep only the part for obs_t
+        if self.single_pass:
+          self._phi,  _ = self._split_batch(self._phi)
+          self.a_var, _ = self._split_batch(self.a_var)
+      x = mean
 
     return x
 
@@ -78,19 +83,10 @@ class BDQN(DDQN):
     Returns:
       tf.Op: The train Op for BLR
     """
-    target = tf.expand_dims(target, axis=-1)
+    # Every example updates only the BLR of the action taken
+    w_update = self.agent_blr.train(phi, target, self.act_t_ph)
 
-    def train_blr(blr, a):
-      """Given a BLR instance, select only the examples for the corresponding action"""
-      mask = tf.expand_dims(tf.equal(self.act_t_ph, a), axis=-1)
-      mask = tf.cast(mask, tf.float32)  # out shape: [None]
-      X = phi * mask                    # out shape: [None, dim_phi]
-      y = target * mask                 # out shape: [None, 1]
-      return blr.train(X, y)
-
-    w_updates = [train_blr(blr, i) for i, blr in enumerate(self.agent_blr)]
-
-    return tf.group(*w_updates, name=name)
+    return tf.group(w_update, name=name)
 
 
   def _compute_target(self, target_net):
@@ -99,8 +95,41 @@ class BDQN(DDQN):
     return target
 
 
+  def _ckpt_stack_map(self):
+    """Older checkpoints store a separate `BLR` layer for each action, named `blr`, `blr_1`, ...,
+    `blr_{n_actions-1}` in the order of creation"""
+
+    def layer_name(i):
+      return "blr" if i == 0 else "blr_%d" % i
+
+    stack_map = {}
+    for blr in [self.agent_blr, self.target_blr]:
+      for var in [blr.w_mu, blr.w_Sigma, blr.w_Lambda, blr.w]:
+        # var.op.name has the form "<net>/action_value/<blr_scope>/<var_name>"
+        scope, _, var_name = var.op.name.rsplit("/", 2)
+        old_names = [scope + "/" + layer_name(i) + "/" + var_name for i in range(self.n_actions)]
+        stack_map[var.op.name] = (old_names, 0)
+    return stack_map
+
+
+  def _build_accum_blr_ops(self, phi, target):
+    """Build the ops for training the Bayesian Linear Regression from data streamed in chunks
+    Args:
+      phi: tf.Tensor, shape: `[None, dim_phi]`. The feature tensor
+      target: tf.Tensor, as returned by `self._compute_target()`; `[None]`
+    Returns:
+      tuple of tf.Ops: The op which accumulates the fed batch and the op which updates the posterior
+    """
+    accum_op  = self.agent_blr.accumulate(phi, target, self.act_t_ph)
+    accum_op  = tf.group(accum_op, name="accum_blr")
+    update_op = tf.group(self.agent_blr.train_accumulated(), name="update_blr")
+
+    return accum_op, update_op
+
+
   def _build_train_op(self, optimizer, loss, agent_vars, name):
     self.train_blr = self._build_train_blr_op(self._phi, self._target, name="train_blr")
+    self.accum_blr, self.update_blr = self._build_accum_blr_ops(self._phi, self._target)
 
     return super()._build_train_op(optimizer, loss, agent_vars, name)
 
@@ -113,6 +142,9 @@ class BDQN_TS(BDQN):
 
     super().__init__(mode="ts", **kwargs)
 
+    # The weights are resampled at the start of every episode
+    self.episodic_policy = True
+
     # Custom TF Tensors and Ops
     self.reset_ts   = None    # Op that resamples the parameters for TS
 
@@ -120,8 +152,9 @@ class BDQN_TS(BDQN):
   def build(self):
     super().build()
 
-    agent_w   = [blr.w            for blr in self.agent_blr]
-    target_w  = [blr.resample_w() for blr in self.target_blr]
+    # Resample the weights for all actions at once
+    agent_w   = [self.agent_blr.w]
+    target_w  = [self.target_blr.resample_w()]
 
     self.reset_ts = tf_utils.assign_vars(agent_w, target_w, name="reset_ts")
 
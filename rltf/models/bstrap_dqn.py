@@ -33,20 +33,6 @@ class BaseBstrapDQN(BaseDQN):
     Returns:
       `tf.Tensor` of shape `[batch_size, n_heads, n_actions]`. Contains the Q-function for each action
     """
-    n_actions = self.n_actions
-
-    def build_head(x):
-      """ Build the head of the DQN network
-      Args:
-        x: tf.Tensor. Tensor for the input
-      Returns:
-        `tf.Tensor` of shape `[batch_size, 1, n_actions]`. Contains the Q-function for each action
-      """
-      x = tf.layers.dense(x, units=512,       activation=tf.nn.relu)
-      x = tf.layers.dense(x, units=n_actions, activation=None)
-      x = tf.expand_dims(x, axis=-2)
-      return x
-
     with tf.variable_scope("conv_net"):
       x = tf.layers.conv2d(x, filters=32, kernel_size=8, strides=4, padding="SAME", activation=tf.nn.relu)
       x = tf.layers.conv2d(x, filters=64, kernel_size=4, strides=2, padding="SAME", activation=tf.nn.relu)
@@ -54,12 +40,75 @@ class BaseBstrapDQN(BaseDQN):
     x = tf.layers.flatten(x)
     # Careful: Make sure self._conv_out is set only during the right function call
     if "agent_net" in tf.get_variable_scope().name and self._conv_out is None: self._conv_out = x
+    # All heads are computed at once with batched weights instead of a separate layer for each head
     with tf.variable_scope("action_value"):
-      heads = [build_head(x) for _ in range(self.n_heads)]
-      x = tf.concat(heads, axis=-2)
+      x = self._heads_dense(x, units=512,            activation=tf.nn.relu, name="heads_hidden")
+      x = self._heads_dense(x, units=self.n_actions, activation=None,       name="heads_out")
+    return x
+
+
+  def _heads_dense(self, x, units, activation, name):
+    """Apply a separate dense layer for each head using a single batched weight tensor.
+    When the input is shared by all heads, the kernel has shape `[in, n_heads, units]` and all heads
+    are computed with a single matrix multiplication. Otherwise, the kernel has shape
+    `[n_heads, in, units]` and a batched matrix multiplication is used.
+    Args:
+      x: tf.Tensor. Input of shape `[batch_size, in]`, shared by all heads, or of shape
+        `[batch_size, n_heads, in]`, separate for each head
+      units: int. Number of output units of every head
+      activation: callable or None. Activation function
+      name: str. Variable scope of the layer
+    Returns:
+      `tf.Tensor` of shape `[batch_size, n_heads, units]`
+    """
+    n_heads   = self.n_heads
+    in_units  = x.shape.as_list()[-1]
+
+    # Initialize every head as tf.layers.dense would - Glorot uniform over the single head fans
+    limit     = (6.0 / (in_units + units)) ** 0.5
+    init      = tf.random_uniform_initializer(-limit, limit)
+
+    with tf.variable_scope(name):
+      if x.shape.ndims == 2:
+        kernel  = tf.get_variable("kernel", shape=[in_units, n_heads, units], initializer=init)
+        x       = tf.matmul(x, tf.reshape(kernel, [in_units, n_heads * units]))
+        x       = tf.reshape(x, [-1, n_heads, units])
+      else:
+        kernel  = tf.get_variable("kernel", shape=[n_heads, in_units, units], initializer=init)
+        x       = tf.einsum("bhi,hiu->bhu", x, kernel)
+      bias      = tf.get_variable("bias",   shape=[n_heads, units], initializer=tf.zeros_initializer())
+      x         = x + bias
+
+    if activation is not None:
+      x = activation(x)
     return x
 
 
+  def _ckpt_stack_map(self):
+    """Older checkpoints store each head as two separate `tf.layers.dense` layers, named
+    `dense`, `dense_1`, ..., `dense_{2*n_heads-1}` in the order of creation"""
+
+    def layer_name(i):
+      return "dense" if i == 0 else "dense_%d" % i
+
+    # Stacking axis of the old variables for every batched variable
+    layers = [
+      ("heads_hidden/kernel", 0, 1),
+      ("heads_hidden/bias",   0, 0),
+      ("heads_out/kernel",    1, 0),
+      ("heads_out/bias",      1, 0),
+    ]
+
+    stack_map = {}
+    for net in ["agent_net", "target_net"]:
+      scope = net + "/action_value/"
+      for name, offset, axis in layers:
+        var       = name.split("/")[-1]
+        old_names = [scope + layer_name(2*i + offset) + "/" + var for i in range(self.n_heads)]
+        stack_map[scope + name] = (old_names, axis)
+    return stack_map
+
+
   def _compute_estimate(self, agent_net):
     """Get the Q value for the selected action
     Returns:
@@ -82,7 +131,7 @@ class BaseBstrapDQN(BaseDQN):
     n_actions   = self.n_actions
 
     # Compute the Q-estimate with the agent network variables and select the maximizing action
-    agent_net   = self._nn_model(self.obs_tp1, scope="agent_net")       # out: [None, n_heads, n_actions]
+    agent_net   = self._agent_net_tp1()                                  # out: [None, n_heads, n_actions]
     target_act  = tf.argmax(agent_net, axis=-1, output_type=tf.int32)   # out: [None, n_heads]
 
     # Select the target Q-function
@@ -206,6 +255,9 @@ class BstrapDQN(BaseBstrapDQN):
 
     super().__init__(**kwargs)
 
+    # The active head is resampled at the start of every episode
+    self.episodic_policy = True
+
     # Custom TF Tensors and Ops
     self._active_head   = None
     self._set_act_head  = None
@@ -128,26 +128,27 @@ class C51(BaseDQN):
       tf.Tensor of shape `[None, N]`, which contains the projected distribution
     """
 
-    # Clip the atom supports in [V_min, V_max]
-    atoms = tf.clip_by_value(atoms, self.V_min, self.V_max)   # [None, N]
-    atoms = tf.expand_dims(atoms, axis=-2)                    # [None, 1, N]
-    atoms = tf.tile(atoms, [1, self.N, 1])                    # [None, N, N]
-
-    # Compute the temporal difference between atoms and bins
-    td_z  = atoms - tf.reshape(self.bins, [1, self.N, 1])     # [None, N, N]
-    # td_z[0] =
-    # [ [tz1-z1, tz2-z1, ..., tzN-z1],
-    #   [tz1-z2, tz2-z2, ..., tzN-z2],
-    #   ...
-    #   [tz1-zN, tzN-zN, ..., tzN-zN]  ]
-
-    # Compute the projection weights and clip them between 0 and 1
-    # Corresponds to `[1 - |[\hat{T}z_j]_{V_min}^{V_max} - z_i| / (\Delta z) ]_0^1` in Eq. (7)
-    weights = tf.clip_by_value(1 - tf.abs(td_z) / self.dz, 0, 1)
-
-    # Compute the projected probabilities
-    p       = tf.expand_dims(p, axis=1)                     # [None, 1, N]
-    proj_p  = tf.reduce_sum(weights * p, axis=-1)           # [None, N]
+    N       = self.N
+
+    # Clip the atom supports in [V_min, V_max] and compute their position in units of bins
+    atoms   = tf.clip_by_value(atoms, self.V_min, self.V_max)         # [None, N]
+    pos     = (atoms - self.V_min) / self.dz                          # [None, N]
+    pos     = tf.clip_by_value(pos, 0.0, N - 1.0)
+
+    # The weights `[1 - |[\hat{T}z_j]_{V_min}^{V_max} - z_i| / (\Delta z) ]_0^1` in Eq. (7) are
+    # non-zero only for the two bins adjacent to each atom. Compute only these instead of all N x N
+    lower   = tf.floor(pos)
+    w_upper = pos - lower                                             # [None, N]
+    w_lower = 1.0 - w_upper                                           # [None, N]
+    lower   = tf.cast(lower, tf.int32)
+    upper   = tf.minimum(lower + 1, N - 1)
+
+    # Scatter the probability mass into the bins of each sample in the flattened batch
+    offset  = tf.expand_dims(tf.range(tf.shape(p)[0]) * N, axis=-1)    # [None, 1]
+    inds    = tf.concat([lower + offset, upper + offset], axis=-1)    # [None, 2N]
+    mass    = tf.concat([w_lower * p, w_upper * p], axis=-1)          # [None, 2N]
+    proj_p  = tf.unsorted_segment_sum(mass, inds, num_segments=tf.shape(p)[0] * N)
+    proj_p  = tf.reshape(proj_p, [-1, N])                             # [None, N]
 
     return proj_p
 
@@ -210,12 +210,20 @@ class DDPG(BaseQlearn):
 
 
   def action_train_ops(self, sess, state, run_dict=None):
-    feed_dict = {self.obs_t_ph: state[None,:], self._training: False}
+    return self.batch_action_train_ops(sess, state[None,:], run_dict)
+
+
+  def batch_action_train_ops(self, sess, states, run_dict=None):
+    feed_dict = {self.obs_t_ph: states, self._training: False}
     return super()._action_train_ops(sess, run_dict, feed_dict=feed_dict)
 
 
   def action_eval_ops(self, sess, state, run_dict=None):
-    feed_dict = {self.obs_t_ph: state[None,:], self._training: False}
+    return self.batch_action_eval_ops(sess, state[None,:], run_dict)
+
+
+  def batch_action_eval_ops(self, sess, states, run_dict=None):
+    feed_dict = {self.obs_t_ph: states, self._training: False}
     return super()._action_eval_ops(sess, run_dict, feed_dict=feed_dict)
 
 
@@ -2,6 +2,7 @@ import logging
 import tensorflow as tf
 
 from rltf.monitoring import vplot_manager
+from rltf.tf_utils   import tf_utils
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,10 @@ class Model:
     # restored and reused from an already trained model
     self.notrain_re = None
 
+    # True if `reset()` samples a new policy for the next episode, e.g. Thompson sampling of the
+    # weights. The model then has a single active policy and cannot drive several envs in lockstep
+    self.episodic_policy = False
+
     self._vars      = None  # List of all model variables
 
 
@@ -64,6 +69,19 @@ class Model:
     raise NotImplementedError()
 
 
+  def batch_action_train_ops(self, sess, states, run_dict=None):
+    """Same as `action_train_ops()`, but computes the training actions for a batch of states
+    with a single `sess.run()`, e.g. for several environments stepped in lockstep.
+    Args:
+      sess: tf.Session(). Currently open session
+      states: np.array. Batch of observations for the current states
+      run_dict: dict of str-tf.Tensor pairs. Contains any additional tensors to run
+    Returns:
+      dict of str-np.array pairs. Contains the actions, additional model tensors and run_dict
+    """
+    raise NotImplementedError()
+
+
   def action_eval_ops(self, sess, state, run_dict=None):
     """Compute the action that should be taken in evaluation mode and any additional tensors.
     Args:
@@ -76,6 +94,19 @@ class Model:
     raise NotImplementedError()
 
 
+  def batch_action_eval_ops(self, sess, states, run_dict=None):
+    """Same as `action_eval_ops()`, but computes the evaluation actions for a batch of states
+    with a single `sess.run()`, e.g. for several environments stepped in lockstep.
+    Args:
+      sess: tf.Session(). Currently open session
+      states: np.array. Batch of observations for the current states
+      run_dict: dict of str-tf.Tensor pairs. Contains any additional tensors to run
+    Returns:
+      dict of str-np.array pairs. Contains the actions, additional model tensors and run_dict
+    """
+    raise NotImplementedError()
+
+
   def _action_train_ops(self, sess, run_dict, feed_dict):
     if run_dict is None:
       run_dict = self.train_dict
@@ -106,6 +137,27 @@ class Model:
     self.notrain_re = regex
 
 
+  def restore(self, sess, ckpt_path, var_list=None):
+    """Restore variables from a checkpoint. Supports checkpoints which store some of the variables
+    in an older layout. See `self._ckpt_stack_map()`
+    Args:
+      sess: tf.Session. Currently open session
+      ckpt_path: str. Path to the checkpoint
+      var_list: list of `tf.Variable`s. Variables to restore. If None, all global variables
+    """
+    tf_utils.restore_vars(sess, ckpt_path, var_list, self._ckpt_stack_map())
+
+
+  def _ckpt_stack_map(self):
+    """
+    Returns:
+      dict of str-tuple pairs or None. Maps the name of a model variable to a tuple `(old_names, axis)`
+      of the names of the variables which are stacked along `axis` to form it. Used to restore
+      checkpoints with an older layout. See `tf_utils.restore_vars()`
+    """
+    return None
+
+
   def _trainable_variables(self, scope):
     """Get the trainable variables in the given scope and remove any which match `self.notrain_re`
     Args:
@@ -7,7 +7,7 @@ from rltf.tf_utils  import tf_utils, tf_ops
 
 class QRDQN(BaseDQN):
 
-  def __init__(self, N, k, **kwargs):
+  def __init__(self, N, k, loss_chunk=None, **kwargs):
     """
     Args:
       obs_shape: list. Shape of the observation tensor
@@ -15,10 +15,16 @@ class QRDQN(BaseDQN):
       opt_conf: rltf.optimizers.OptimizerConf. Configuration for the optimizer
       N: int. number of quantiles
       k: int. Huber loss order
+      loss_chunk: int or None. If not None, compute the loss and its gradient by streaming over
+        chunks of `loss_chunk` target quantiles. Peak memory becomes `O(batch_size*N*loss_chunk)`
+        instead of `O(batch_size*N*N)`. Must divide `N`
     """
     super().__init__(**kwargs)
     self.N = N
     self.k = k
+    self.loss_chunk = loss_chunk
+
+    assert loss_chunk is None or N % loss_chunk == 0
 
 
   def _conv_nn(self, x):
@@ -119,8 +125,31 @@ class QRDQN(BaseDQN):
     # Compute the tensor of mid-quantiles
     mid_quantiles = (np.arange(0, self.N, 1, dtype=np.float64) + 0.5) / float(self.N)
     mid_quantiles = np.asarray(mid_quantiles, dtype=np.float32)
-    mid_quantiles = tf.constant(mid_quantiles[None, None, :], dtype=tf.float32)
 
+    if self.loss_chunk is None:
+      quantile_loss = self._quantile_loss(z, target_z, tf.constant(mid_quantiles[None, None, :]))
+      quantile_loss = tf.reduce_mean(quantile_loss, axis=-1)  # Expected loss for each quntile
+    else:
+      quantile_loss = self._chunked_quantile_loss(z, target_z, mid_quantiles)
+
+    loss          = tf.reduce_sum(quantile_loss, axis=-1)     # Sum loss over all quantiles
+    loss          = tf.reduce_mean(loss)                      # Average loss over the batch
+
+    tf.summary.scalar(name, loss)
+
+    return loss
+
+
+  def _quantile_loss(self, z, target_z, mid_quantiles, grad=False):
+    """Compute the quantile (Huber) loss between every quantile and every target quantile.
+    Args:
+      z: `tf.Tensor`, shape `[None, N]`. Estimated quantiles
+      target_z: `tf.Tensor`, shape `[None, M]`. Target quantiles
+      mid_quantiles: `tf.Tensor`, shape `[1, 1, M]`. Quantile midpoints matching `target_z`
+      grad: bool. If True, return the derivative of the loss w.r.t. `td_z` instead of the loss
+    Returns:
+      `tf.Tensor` of shape `[None, N, M]`
+    """
     # Operate over last dimensions to average over samples (target locations)
     td_z          = tf.expand_dims(target_z, axis=-2) - tf.expand_dims(z, axis=-1)
     # td_z[0] =
@@ -128,29 +157,75 @@ class QRDQN(BaseDQN):
     #   [tz1-z2, tz2-z2, ..., tzN-z2],
     #   ...
     #   [tz1-zN, tzN-zN, ..., tzN-zN]  ]
-    indicator_fn  = tf.to_float(td_z < 0.0)                   # out: [None, N, N]
+    indicator_fn  = tf.to_float(td_z < 0.0)                   # out: [None, N, M]
 
     # Compute the quantile penalty weights
-    quant_weight  = mid_quantiles - indicator_fn              # out: [None, N, N]
+    quant_weight  = mid_quantiles - indicator_fn              # out: [None, N, M]
     # Make sure no gradient flows through the indicator function. The penalty is only a scaling factor
     quant_weight  = tf.stop_gradient(quant_weight)
 
     # Pure Quantile Regression Loss
     if self.k == 0:
-      quantile_loss = quant_weight * td_z                     # out: [None, N, N]
+      if grad:
+        return quant_weight
+      quantile_loss = quant_weight * td_z                     # out: [None, N, M]
     # Quantile Huber Loss
     else:
       quant_weight  = tf.abs(quant_weight)
+      if grad:
+        return quant_weight * tf.clip_by_value(td_z, -float(self.k), float(self.k))
       huber_loss    = tf_ops.huber_loss(td_z, delta=np.float32(self.k))
-      quantile_loss = quant_weight * huber_loss               # out: [None, N, N]
+      quantile_loss = quant_weight * huber_loss               # out: [None, N, M]
 
-    quantile_loss = tf.reduce_mean(quantile_loss, axis=-1)    # Expected loss for each quntile
-    loss          = tf.reduce_sum(quantile_loss, axis=-1)     # Sum loss over all quantiles
-    loss          = tf.reduce_mean(loss)                      # Average loss over the batch
+    return quantile_loss
 
-    tf.summary.scalar(name, loss)
 
-    return loss
+  def _chunked_quantile_loss(self, z, target_z, mid_quantiles):
+    """Compute the expected quantile loss for each quantile by streaming over chunks of target
+    quantiles. The gradient is computed in the same way, so no `[None, N, N]` tensors are kept
+    Args:
+      z: `tf.Tensor`, shape `[None, N]`. Estimated quantiles
+      target_z: `tf.Tensor`, shape `[None, N]`. Target quantiles
+      mid_quantiles: np.array, shape `[N]`. Quantile midpoints
+    Returns:
+      `tf.Tensor` of shape `[None, N]`
+    """
+    N         = self.N
+    chunk     = self.loss_chunk
+    n_chunks  = N // chunk
+    taus      = tf.constant(np.reshape(mid_quantiles, [n_chunks, 1, 1, chunk]))
+
+    def split_chunks(target_z):
+      target_z = tf.reshape(target_z, [-1, n_chunks, chunk])
+      return tf.transpose(target_z, [1, 0, 2])                # out: [n_chunks, None, chunk]
+
+    @tf.custom_gradient
+    def quantile_loss(z, target_z):
+      tz_chunks = split_chunks(target_z)
+
+      def chunk_loss(elems):
+        tz, tau = elems
+        return tf.reduce_sum(self._quantile_loss(z, tz, tau), axis=-1)   # out: [None, N]
+
+      loss = tf.map_fn(chunk_loss, (tz_chunks, taus), dtype=tf.float32, parallel_iterations=1,
+                       back_prop=False)
+      loss = tf.reduce_sum(loss, axis=0) / float(N)           # out: [None, N]
+
+      def grad_fn(dy):
+        def chunk_grad(elems):
+          tz, tau = elems
+          td_grad = self._quantile_loss(z, tz, tau, grad=True) * tf.expand_dims(dy, axis=-1)
+          return tf.reduce_sum(td_grad, axis=-1), tf.reduce_sum(td_grad, axis=-2)
+
+        z_grad, tz_grad = tf.map_fn(chunk_grad, (tz_chunks, taus), dtype=(tf.float32, tf.float32),
+                                    parallel_iterations=1, back_prop=False)
+        z_grad  = -tf.reduce_sum(z_grad, axis=0) / float(N)                     # out: [None, N]
+        tz_grad = tf.reshape(tf.transpose(tz_grad, [1, 0, 2]), [-1, N]) / float(N)
+        return z_grad, tz_grad
+
+      return loss, grad_fn
+
+    return quantile_loss(z, target_z)
 
 
   def _act_train(self, agent_net, name):
@@ -2,3 +2,4 @@ from rltf.monitoring.monitor  import Monitor
 from rltf.monitoring.stats    import StatsRecorder
 from rltf.monitoring          import vplot_manager
 from rltf.monitoring.vplot    import VideoPlotter
+from rltf.monitoring.profiler import Profiler
@@ -45,7 +45,8 @@ class Monitor(Wrapper):
     - The TF graph is available in the thread running `env.step()`
   """
 
-  def __init__(self, env, log_dir, mode, log_period=None, video_spec=None, eval_period=None):
+  def __init__(self, env, log_dir, mode, log_period=None, video_spec=None, eval_period=None,
+               agent_step_size=1):
     """
     Args:
       log_dir: str. The directory where to save the monitor videos and stats
@@ -57,6 +58,7 @@ class Monitor(Wrapper):
         - `False`, disables video recording
         - If `None`, every 1000th episode is recorded
       eval_period: int. Required only in evaluation mode. Needed to compute the correct logging step.
+      agent_step_size: int. Number of agent steps covered by a single step of the env. See `StatsRecorder`
     """
 
     assert mode in ['t', 'e']
@@ -75,7 +77,7 @@ class Monitor(Wrapper):
     self._make_log_dir()
 
     # Composition objects
-    self.stats_recorder = StatsRecorder(log_dir, mode, log_period, eval_period)
+    self.stats_recorder = StatsRecorder(log_dir, mode, log_period, eval_period, agent_step_size)
     self.video_plotter  = VideoPlotter(self.env, mode=mode)
     self.video_recorder = None
 
@@ -98,6 +100,7 @@ class Monitor(Wrapper):
     self.set_summary_getter = self.stats_recorder.set_summary_getter
     self.save               = self.stats_recorder.save
     self.log_stats          = self.stats_recorder.log_stats
+    self.add_episodes       = self.stats_recorder.add_episodes
 
 
   def _attach_env_methods(self):
@@ -0,0 +1,182 @@
+import functools
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+
+# Upper limits (in seconds) of the histogram bins of phase durations: from 1us to 100s, 10 bins per decade
+BIN_LIMITS = np.logspace(-6, 2, 81)
+
+
+class Profiler:
+  """Lightweight wall-clock timing of the phases of an agent's hot path. A phase is timed with
+  ```
+  with profiler.phase("env_step"):
+    obs, reward, done, info = env.step(action)
+  ```
+  or by decorating a function with `@profiler.timed("env_step")`. The durations of every phase are
+  aggregated in a fixed histogram until `collect()` is called.
+
+  When the profiler is disabled, `phase()` returns a shared no-op context manager and `timed()` returns
+  the function unchanged, so instrumented code costs only a method call.
+
+  NOTE: Phases can be timed concurrently from several threads. A single phase must not be timed
+  concurrently from several threads
+  """
+
+  def __init__(self, enabled=False):
+    """
+    Args:
+      enabled: bool. If False, no timing is performed
+    """
+    self.enabled  = enabled
+    self._phases  = {}
+    self._lock    = threading.Lock()
+
+
+  def phase(self, name):
+    """Return a context manager which times the code in its scope as the phase `name`"""
+    if not self.enabled:
+      return _NULL_PHASE
+    return _Phase(self._get_stats(name))
+
+
+  def timed(self, name):
+    """Return a decorator which times every call of the decorated function as the phase `name`"""
+    def decorator(f):
+      if not self.enabled:
+        return f
+
+      stats = self._get_stats(name)
+
+      @functools.wraps(f)
+      def wrapper(*args, **kwargs):
+        with _Phase(stats):
+          return f(*args, **kwargs)
+      return wrapper
+
+    return decorator
+
+
+  def collect(self):
+    """Return the statistics of all phases since the last call and reset them
+    Returns:
+      dict of str-dict pairs. For every phase, contains a dict with keys `"count"`, `"total"`,
+      `"sum_sq"`, `"mean"` and `"max"` (in seconds) and `"hist"` - the counts of the durations in the
+      bins of `BIN_LIMITS`
+    """
+    with self._lock:
+      phases = list(self._phases.items())
+
+    data = {}
+    for name, stats in phases:
+      data[name] = stats.collect()
+    return data
+
+
+  def _get_stats(self, name):
+    stats = self._phases.get(name, None)
+    if stats is None:
+      with self._lock:
+        stats = self._phases.setdefault(name, _PhaseStats())
+    return stats
+
+
+
+class _PhaseStats:
+  """Running statistics of the durations of a single phase"""
+
+  def __init__(self):
+    self.count  = 0
+    self.total  = 0.0
+    self.sum_sq = 0.0
+    self.max    = 0.0
+    self.hist   = np.zeros(len(BIN_LIMITS) + 1, dtype=np.int64)
+
+
+  def add(self, duration):
+    self.count  += 1
+    self.total  += duration
+    self.sum_sq += duration * duration
+    self.max    = max(self.max, duration)
+    self.hist[np.searchsorted(BIN_LIMITS, duration)] += 1
+
+
+  def collect(self):
+    # Swap the histogram first, so a concurrent add() is at worst counted in the next period
+    hist, self.hist     = self.hist, np.zeros_like(self.hist)
+    count, self.count   = self.count, 0
+    total, self.total   = self.total, 0.0
+    sum_sq, self.sum_sq = self.sum_sq, 0.0
+    dmax, self.max      = self.max, 0.0
+
+    mean = total / count if count > 0 else np.nan
+    return dict(count=count, total=total, sum_sq=sum_sq, mean=mean, max=dmax, hist=hist)
+
+
+
+class _Phase:
+
+  __slots__ = ["stats", "start"]
+
+  def __init__(self, stats):
+    self.stats = stats
+    self.start = None
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.stats.add(time.perf_counter() - self.start)
+    return False
+
+
+
+class _NullPhase:
+
+  __slots__ = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+
+def add_summary(summary, data, prefix="profile/"):
+  """Append the phase statistics returned by `Profiler.collect()` to a `tf.Summary`. For every phase
+  adds the mean duration and the total time (in milliseconds) and a histogram of the durations
+  Args:
+    summary: tf.Summary. The summary to append
+    data: dict. The result of `Profiler.collect()`
+    prefix: str. Prefix for the summary tags
+  """
+  for name, stats in data.items():
+    if stats["count"] == 0:
+      continue
+
+    tag = prefix + name
+    summary.value.add(tag=tag + "/mean_ms",  simple_value=1000 * stats["mean"])
+    summary.value.add(tag=tag + "/total_ms", simple_value=1000 * stats["total"])
+
+    hist  = stats["hist"]
+    inds  = np.flatnonzero(hist)
+    # The last bin has no upper limit - use the largest duration instead
+    limits = np.append(BIN_LIMITS, max(stats["max"], BIN_LIMITS[-1])) * 1000
+
+    histo = tf.HistogramProto(
+      min=float(limits[inds[0]-1]) if inds[0] > 0 else 0.0,
+      max=1000 * stats["max"],
+      num=stats["count"],
+      sum=1000 * stats["total"],
+      sum_squares=1e6 * stats["sum_sq"],
+      bucket_limit=[float(limits[i]) for i in inds],
+      bucket=[float(hist[i]) for i in inds],
+    )
+    summary.value.add(tag=tag + "/hist_ms", histo=histo)
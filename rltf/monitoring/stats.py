@@ -20,7 +20,7 @@ N_EPS_STATS   = 100
 
 class StatsRecorder:
 
-  def __init__(self, log_dir, mode, log_period=None, eval_period=None):
+  def __init__(self, log_dir, mode, log_period=None, eval_period=None, agent_step_size=1):
     """
     Args:
       log_dir: str. The path for the directory where the videos are saved
@@ -29,10 +29,13 @@ class StatsRecorder:
         Otherwise, log_stats() has to be called from outside. If mode == 'e', then it must be provided and
         must equal the evaluation length in order to keep correct evaluation statistics
       eval_period: int. Required only in evaluation mode. Needed to compute the correct logging step.
+      agent_step_size: int. Number of agent steps covered by a single step of the env, e.g. when
+        several envs are stepped in lockstep and only one of them is monitored. Must divide `log_period`
     """
 
     if log_period is not None:
       assert log_period > 0
+      assert log_period % agent_step_size == 0
       autolog = True
     else:
       assert mode != 'e', "'log_period' must be provided in evaluation mode"
@@ -44,6 +47,7 @@ class StatsRecorder:
     self.tb_dir       = os.path.join(log_dir, "tb/")
     self.autolog      = autolog
     self.log_period   = log_period
+    self.agent_step_size = agent_step_size
     self._mode        = mode      # Running mode: either 't' (train) or 'e' (eval)
     self.n_episodes   = N_EPS_STATS if log_period is not None else None
     self.eval_period  = eval_period
@@ -79,13 +83,20 @@ class StatsRecorder:
     # In train mode:
     #   - stats_steps corresponds to the agent train step at each logging report
     #   - stats_inds corresponds to the total number of complete train episodes at each logging report
-    self.ep_rews      = []    # List of the cumulative returns of all environment episodes
-    self.ep_lens      = []    # List of the lengths of all environment episodes
+    self.ep_rews      = GrowableArray(np.float64)   # The cumulative returns of all environment episodes
+    self.ep_lens      = GrowableArray(np.int32)     # The lengths of all environment episodes
     self.stats_steps  = []    # The agent step at each logging event
     self.stats_inds   = []    # The number of env episodes at each logging event
     self.stats        = None  # A dictionary with runtime statistics
     self.active       = False # Track whether env.step and env.reset() were executed via this monitor
 
+    # Streaming statistics of the episodes. The window statistics track the last `self.n_episodes`
+    # episodes and the period statistics track the episodes since the last logging event
+    self._win_rews    = RunningStats(self.n_episodes)
+    self._win_lens    = RunningStats(self.n_episodes)
+    self._period_rews = RunningStats()
+    self._period_lens = RunningStats()
+
     # Episode tracking
     self.ep_reward  = None      # Track the episode reward so far
     self.step_rew   = None      # Track the total reward from the current agent step
@@ -107,7 +118,7 @@ class StatsRecorder:
 
   def before_agent_step(self, action):
     self.active = True
-    self._agent_steps += 1
+    self._agent_steps += self.agent_step_size
     # Keep this here. Sometimes, env.reset() might induce env.step(), but not
     # agent.env.step() due to Wrapper behavior
     self.step_rew = 0
@@ -177,12 +188,34 @@ class StatsRecorder:
 
     # Append episode data only if the env has advertised done
     if self.env_done:
-      self.ep_lens.append(self.ep_steps)
-      self.ep_rews.append(self.ep_reward)
+      self._add_episode(self.ep_reward, self.ep_steps)
       self._env_steps += self.ep_steps
       self.env_done = None
 
 
+  def _add_episode(self, ep_rew, ep_len):
+    self.ep_rews.append(ep_rew)
+    self.ep_lens.append(ep_len)
+    self._win_rews.add(ep_rew)
+    self._win_lens.add(ep_len)
+    self._period_rews.add(ep_rew)
+    self._period_lens.add(ep_len)
+
+
+  def add_episodes(self, ep_rews, ep_lens):
+    """Append complete episodes which were recorded by another monitor, e.g. by the monitor of
+    another environment which is run in lockstep with this one
+    Args:
+      ep_rews: list or np.array. The cumulative returns of the episodes
+      ep_lens: list or np.array. The lengths of the episodes
+    """
+    assert len(ep_rews) == len(ep_lens)
+    for ep_rew, ep_len in zip(ep_rews, ep_lens):
+      self._add_episode(ep_rew, ep_len)
+    self._env_steps += int(np.sum(ep_lens))
+    self._env_eps   += len(ep_lens)
+
+
   def env_reset(self):
     self.ep_steps   = 0
     self.ep_reward  = 0
@@ -409,14 +442,17 @@ class StatsRecorder:
     if self.mode == 't':
       time_now      = time.time()
       steps_per_sec = (self._agent_steps - stats["last_log_step"]) / (time_now - stats["last_log_time"])
-      lo            = stats["last_log_ep"] if self.n_episodes is None else -self.n_episodes
+      if self.n_episodes is None:
+        rews, lens  = self._period_rews, self._period_lens
+      else:
+        rews, lens  = self._win_rews, self._win_lens
 
-      stats["mean_ep_rew"]    = stats_mean(self.ep_rews[lo:])
-      stats["std_ep_rew"]     = stats_std(self.ep_rews[lo:])
-      stats["ep_len_mean"]    = stats_mean(self.ep_lens[lo:])
-      stats["ep_len_std"]     = stats_std(self.ep_lens[lo:])
+      stats["mean_ep_rew"]    = rews.mean
+      stats["std_ep_rew"]     = rews.std
+      stats["ep_len_mean"]    = lens.mean
+      stats["ep_len_std"]     = lens.std
       stats["best_mean_rew"]  = max(stats["best_mean_rew"], stats["mean_ep_rew"])
-      stats["best_ep_rew"]    = stats_best(stats["best_ep_rew"], self.ep_rews, stats["last_log_ep"])
+      stats["best_ep_rew"]    = max(stats["best_ep_rew"], self._period_rews.max)
 
       stats["last_log_ep"]    = len(self.ep_rews)
       stats["steps_per_sec"]  = steps_per_sec
@@ -426,19 +462,16 @@ class StatsRecorder:
     # Update eval mode statistics
     else:
       # Logging means that an evaluation run is finished, so it is time to update the statistics
-      # In evaluation mode, statistics are always based on the most recent run
-
-      last_log_ep   = self.stats_inds[-1] if len(self.stats_inds) > 0 else 0
-      episode_rews  = self.ep_rews[last_log_ep:]
-      episode_lens  = self.ep_lens[last_log_ep:]
+      # In evaluation mode, statistics are always based on the most recent run, i.e. on the
+      # episodes since the last logging event
 
-      stats["mean_ep_rew"]    = stats_mean(episode_rews)
-      stats["std_ep_rew"]     = stats_std(episode_rews)
-      stats["ep_len_mean"]    = stats_mean(episode_lens)
-      stats["ep_len_std"]     = stats_std(episode_lens)
+      stats["mean_ep_rew"]    = self._period_rews.mean
+      stats["std_ep_rew"]     = self._period_rews.std
+      stats["ep_len_mean"]    = self._period_lens.mean
+      stats["ep_len_std"]     = self._period_lens.std
       stats["best_mean_rew"]  = max(stats["best_mean_rew"], stats["mean_ep_rew"])
-      stats["best_ep_rew"]    = stats_best(stats["best_ep_rew"], self.ep_rews, stats["last_log_ep"])
-      stats["score_episodes"] = len(episode_rews)
+      stats["best_ep_rew"]    = max(stats["best_ep_rew"], self._period_rews.max)
+      stats["score_episodes"] = self._period_rews.n
       stats["last_log_ep"]    = len(self.ep_rews)
 
       # Append info with best_agent
@@ -448,6 +481,10 @@ class StatsRecorder:
     self.stats_steps.append(self._log_step)
     self.stats_inds.append(len(self.ep_rews))
 
+    # Start a new logging period
+    self._period_rews.reset()
+    self._period_lens.reset()
+
     # Append the TensorBoard summary data
     if self.summary is not None:
       if self.mode == 't':
@@ -518,8 +555,8 @@ class StatsRecorder:
     # Write the data
     self._write_json(json_file, data)
 
-    self._write_npy(ep_rews_file,     np.asarray(self.ep_rews, dtype=np.float32))
-    self._write_npy(ep_lens_file,     np.asarray(self.ep_lens, dtype=np.int32))
+    self._write_npy(ep_rews_file,     self.ep_rews.data.astype(np.float32))
+    self._write_npy(ep_lens_file,     self.ep_lens.data.astype(np.int32))
     self._write_npy(stats_inds_file,  np.asarray(self.stats_inds, dtype=np.int32))
     self._write_npy(stats_steps_file, np.asarray(self.stats_steps, dtype=np.int32))
 
@@ -555,16 +592,35 @@ class StatsRecorder:
       self.stats["best_mean_rew"] = data["best_mean_rew"]
 
     # Read the numpy data
-    self.ep_rews      = self._read_npy(ep_rews_file)
-    self.ep_lens      = self._read_npy(ep_lens_file)
+    self.ep_rews      = GrowableArray(np.float64, data=self._read_npy(ep_rews_file))
+    self.ep_lens      = GrowableArray(np.int32,   data=self._read_npy(ep_lens_file))
     self.stats_inds   = self._read_npy(stats_inds_file)
     self.stats_steps  = self._read_npy(stats_steps_file)
 
+    # Rebuild the streaming statistics
+    last_log_ep = int(self.stats_inds[-1]) if len(self.stats_inds) > 0 else 0
+    first_ep    = max(0, len(self.ep_rews) - self.n_episodes) if self.n_episodes is not None else 0
+    for ep_rew, ep_len in zip(self.ep_rews[first_ep:], self.ep_lens[first_ep:]):
+      self._win_rews.add(ep_rew)
+      self._win_lens.add(ep_len)
+    for ep_rew, ep_len in zip(self.ep_rews[last_log_ep:], self.ep_lens[last_log_ep:]):
+      self._period_rews.add(ep_rew)
+      self._period_lens.add(ep_len)
+    if len(self.ep_rews) > 0:
+      self.stats["best_ep_rew"] = float(np.max(self.ep_rews.data))
+
 
   def close(self):
     self.tb_writer.close()
 
 
+  def reopen_writer(self):
+    """Replace the TensorBoard writer with a new one. Must be called in a forked process, where
+    the thread of the writer in the parent process does not exist. The old writer is not closed"""
+    suffix          = ".train" if self.mode == 't' else ".eval"
+    self.tb_writer  = tf.summary.FileWriter(self.tb_dir, filename_suffix=suffix)
+
+
   def _read_npy(self, file):
     file = os.path.join(self.log_dir, file)
     if os.path.exists(file):
@@ -624,27 +680,133 @@ class StatsRecorder:
 
   @property
   def episode_rews(self):
-    return list(self.ep_rews)
+    return self.ep_rews.data.tolist()
 
   @property
   def episode_lens(self):
-    return list(self.ep_lens)
+    return self.ep_lens.data.tolist()
+
+
+
+class GrowableArray:
+  """1D `np.array` with amortized O(1) `append()`. The capacity is doubled when the array is full"""
+
+  def __init__(self, dtype, capacity=1024, data=None):
+    """
+    Args:
+      dtype: np.dtype. Type of the data
+      capacity: int. Initial capacity
+      data: list or np.array. Initial data
+    """
+    n = len(data) if data is not None else 0
+    self._buf = np.empty(max(capacity, n), dtype=dtype)
+    self._n   = n
+    if n > 0:
+      self._buf[:n] = data
+
+
+  def append(self, value):
+    if self._n == len(self._buf):
+      self._grow(self._n + 1)
+    self._buf[self._n] = value
+    self._n += 1
+
+
+  def extend(self, values):
+    n = self._n + len(values)
+    if n > len(self._buf):
+      self._grow(n)
+    self._buf[self._n:n] = values
+    self._n = n
 
 
-def stats_mean(data):
-  if len(data) > 0:
-    return np.mean(data)
-  return -np.inf
+  def _grow(self, size):
+    capacity = max(size, 2 * len(self._buf))
+    buf = np.empty(capacity, dtype=self._buf.dtype)
+    buf[:self._n] = self._buf[:self._n]
+    self._buf = buf
 
 
-def stats_std(data):
-  if len(data) > 0:
-    return np.std(data)
-  return np.nan
+  @property
+  def data(self):
+    """`np.array` view of the data. Invalidated by the next append"""
+    return self._buf[:self._n]
+
+  def __len__(self):
+    return self._n
+
+  def __getitem__(self, idx):
+    return self.data[idx]
+
+  def __iter__(self):
+    return iter(self.data)
+
+  def __array__(self, dtype=None):
+    return self.data if dtype is None else self.data.astype(dtype)
+
+
+
+class RunningStats:
+  """Streaming mean, standard deviation and maximum of a sequence of values. Every update is O(1).
+  If `window` is not None, the mean and the standard deviation are computed only over the most recent
+  `window` values, which are kept in a ring buffer. The maximum is over all values since `reset()`
+  """
+
+  def __init__(self, window=None):
+    self.window = window
+    self._ring  = np.zeros(window, dtype=np.float64) if window is not None else None
+    self.reset()
+
+
+  def reset(self):
+    self.n        = 0       # Number of values in the statistics
+    self.max      = -np.inf
+    self._sum     = 0.0
+    self._sum_sq  = 0.0
+    self._idx     = 0       # Next index in the ring
+
 
+  def add(self, value):
+    value = float(value)
+    self.max = max(self.max, value)
 
-def stats_best(best, data, i):
-  if len(data[i:]) > 0:
-    data_best = np.max(data[i:])
-    return max(best, data_best)
-  return best
+    if self._ring is None:
+      self.n += 1
+      self._sum    += value
+      self._sum_sq += value * value
+      return
+
+    # Remove the oldest value if the window is full
+    if self.n == self.window:
+      old = self._ring[self._idx]
+      self._sum    -= old
+      self._sum_sq -= old * old
+    else:
+      self.n += 1
+
+    self._ring[self._idx] = value
+    self._idx = (self._idx + 1) % self.window
+
+    # Recompute the sums once per pass over the ring, so floating point errors do not accumulate
+    if self._idx == 0:
+      ring = self._ring[:self.n]
+      self._sum    = float(np.sum(ring))
+      self._sum_sq = float(np.dot(ring, ring))
+    else:
+      self._sum    += value
+      self._sum_sq += value * value
+
+
+  @property
+  def mean(self):
+    if self.n > 0:
+      return self._sum / self.n
+    return -np.inf
+
+
+  @property
+  def std(self):
+    if self.n > 0:
+      mean = self._sum / self.n
+      return np.sqrt(max(0.0, self._sum_sq / self.n - mean * mean))
+    return np.nan
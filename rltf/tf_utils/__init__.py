@@ -3,4 +3,4 @@ from rltf.tf_utils      import ops            as tf_ops
 from rltf.tf_utils      import inverse        as tf_inv
 from rltf.tf_utils      import distributions  as tf_dist
 from rltf.tf_utils      import cg             as tf_cg
-from rltf.tf_utils.blr  import BLR
+from rltf.tf_utils.blr  import BLR, BatchedBLR
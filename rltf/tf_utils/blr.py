@@ -195,3 +195,286 @@ class BLR(tf.layers.Layer):
     if x.dtype.base_dtype != tf.float32:
       x = tf.cast(x, tf.float32)
     return x
+
+
+
+class BatchedBLR(tf.layers.Layer):
+  """Batch of independent Bayesian Linear Regression models which share the same input features,
+  e.g. one model per action. Equivalent to a list of `n_outputs` `BLR` layers, but the weight posteriors
+  are stored in single variables with a leading `n_outputs` dimension and prediction, training and
+  Thompson resampling are each performed by a single batched op.
+
+  NOTE:
+    - Internal variables are not captured by `tf.trainable_variables()` and by optimizers. See `BLR`
+    - For training variables, one needs to use the op returned by `self.train()`. Alternatively,
+      the data can be streamed in chunks through `self.accumulate()` and the posterior updated once
+      with `self.train_accumulated()`
+  """
+
+  def __init__(self, tau, sigma_e, n_outputs, mode="mean", w_dim=None, dtype=tf.float64, name=None):
+
+    super().__init__(trainable=False, dtype=dtype, name=name)
+
+    assert mode in ["mean", "ts"]
+
+    self.sigma      = sigma_e
+    self.beta       = 1.0 / self.sigma**2
+    self.tau        = tau
+    self.n_outputs  = n_outputs
+    self.w_dim      = w_dim
+    self.mode       = mode
+
+    # Custom TF Tensors and Ops
+    self.w_mu     = None  # shape: [n_outputs, w_dim, 1]
+    self.w_Sigma  = None  # shape: [n_outputs, w_dim, w_dim]
+    self.w_Lambda = None  # shape: [n_outputs, w_dim, w_dim]
+    self.w        = None  # Sampled value for w when using Thompson Sampling; [n_outputs, w_dim, 1]
+    self.reset_op = None  # Reset all trainable variables to their initial values
+    self.XtX      = None  # Accumulated X^T X for every model; [n_outputs, w_dim, w_dim]
+    self.Xty      = None  # Accumulated X^T y for every model; [n_outputs, w_dim, 1]
+
+    self.input_spec = tf.layers.InputSpec(min_ndim=2, max_ndim=2)
+
+
+  def build(self, input_shape):
+    input_shape = tf.TensorShape(input_shape)
+
+    if input_shape[-1].value is None:
+      raise ValueError('The last dimension of the inputs to `BatchedBLR` should be defined. Found `None`.')
+
+    if self.w_dim is None:
+      self.w_dim      = input_shape[-1].value
+      self.input_spec = tf.layers.InputSpec(min_ndim=2, max_ndim=2, axes={-1: self.w_dim})
+    else:
+      assert self.w_dim == input_shape[-1].value
+
+    I = tf.eye(self.w_dim, batch_shape=[self.n_outputs], dtype=self.dtype)
+
+    mu_init     = tf.zeros([self.n_outputs, self.w_dim, 1], dtype=self.dtype)
+    Sigma_init  = 1.0/self.tau * I
+    Lambda_init = self.tau * I
+
+    self.w_mu     = self.add_variable("w_mu",
+                                      shape=[self.n_outputs, self.w_dim, 1],
+                                      initializer=tf.zeros_initializer,
+                                      trainable=True)
+
+    self.w_Sigma  = self.add_variable("w_Sigma",
+                                      shape=[self.n_outputs, self.w_dim, self.w_dim],
+                                      initializer=lambda *args, **kwargs: Sigma_init,
+                                      trainable=True)
+
+    self.w_Lambda = self.add_variable("w_Lambda",
+                                      shape=[self.n_outputs, self.w_dim, self.w_dim],
+                                      initializer=lambda *args, **kwargs: Lambda_init,
+                                      trainable=True)
+
+    self.w        = self.add_variable("w",
+                                      shape=[self.n_outputs, self.w_dim, 1],
+                                      initializer=tf.zeros_initializer,
+                                      trainable=False)
+
+    # Build the reset op
+    self.reset_op = self._tf_update_params(mu_init, Sigma_init, Lambda_init)
+
+    self.built = True
+
+
+  def call(self, inputs, **kwargs):
+    """ Compute the posterior predictive distribution of all models
+    Args:
+      X: tf.Tensor, `shape=[None, D]`. The feature matrix
+    Returns:
+      List of `tf.Tensor`s:
+        mu: tf.Tensor, `shape=[None, n_outputs]. The mean at each test point
+        var: tf.Tensor, `shape=[None, n_outputs]. The variance at each test point
+    """
+    X = self._cast_input(inputs)
+
+    # Thompson Sampling Output
+    if self.mode == "ts":
+      w = self.w
+    # Bayesian Regression Output
+    else:
+      w = self.w_mu
+
+    mu  = tf.matmul(X, tf.transpose(tf.squeeze(w, axis=-1)))
+
+    # var[:, a] ends up being diag(sigma**2 + matmul(matmul(X, w_Sigma[a]), X.T))
+    X_Sigma = tf.tensordot(X, self.w_Sigma, axes=[[1], [1]])     # out shape: [None, n_outputs, D]
+    var     = self.sigma**2 + tf.reduce_sum(X_Sigma * tf.expand_dims(X, axis=1), axis=-1)
+
+    outputs = [mu, var]
+    outputs = [self._cast_output(t) for t in outputs]
+    return outputs
+
+
+  def train(self, X, y, index):
+    """Compute the weight posteriors of all models. Every example updates only the posterior of
+    the model selected by `index`
+    Args:
+      X: tf.Tensor, `shape=[None, D]`. The feature matrix
+      y: tf.Tensor, `shape=[None]`. The correct outputs
+      index: tf.Tensor, `shape=[None]`. The index of the model which every example belongs to
+    Returns:
+      tf.Op which performs the update operation
+    """
+    X, y = self._mask_inputs(X, y, index)
+
+    # Compute the posterior precision matrices
+    w_Lambda = self.w_Lambda + self.beta * tf.matmul(X, X, transpose_a=True)
+
+    # Compute the posterior covariance matrices
+    X_norm  = 1.0 / self.sigma * X
+    w_Sigma = tf_inv.woodburry_inverse(self.w_Sigma, tf.matrix_transpose(X_norm), X_norm)
+
+    error = tf.losses.mean_squared_error(tf.matmul(w_Lambda, w_Sigma),
+                                         tf.eye(self.w_dim, batch_shape=[self.n_outputs]))
+    tf.summary.scalar("debug/BLR/inv_error", error)
+
+    # Compute the posterior means
+    w_mu = tf.matmul(w_Sigma, self.beta * tf.matmul(X, y, True) + tf.matmul(self.w_Lambda, self.w_mu))
+
+    return self._tf_update_params(w_mu, w_Sigma, w_Lambda)
+
+
+  def accumulate(self, X, y, index):
+    """Add the sufficient statistics `X^T X` and `X^T y` of a batch of data to the accumulators of
+    the models. The weight posteriors are not changed until `self.train_accumulated()` is run
+    Args:
+      X: tf.Tensor, `shape=[None, D]`. The feature matrix
+      y: tf.Tensor, `shape=[None]`. The correct outputs
+      index: tf.Tensor, `shape=[None]`. The index of the model which every example belongs to
+    Returns:
+      tf.Op which performs the accumulation
+    """
+    self._build_accumulators()
+
+    X, y = self._mask_inputs(X, y, index)
+
+    XtX_op = tf.assign_add(self.XtX, tf.matmul(X, X, transpose_a=True))
+    Xty_op = tf.assign_add(self.Xty, tf.matmul(X, y, transpose_a=True))
+    return tf.group(XtX_op, Xty_op)
+
+
+  def train_accumulated(self):
+    """Compute the weight posteriors of all models from the data accumulated by `self.accumulate()`
+    and clear the accumulators. Equivalent to `self.train()` on all of the accumulated data, but requires
+    only a single inversion of the `[D, D]` precision matrix of every model
+    Returns:
+      tf.Op which performs the update operation
+    """
+    self._build_accumulators()
+
+    # Compute the posterior precision matrices
+    w_Lambda  = self.w_Lambda + self.beta * self.XtX
+
+    # Compute the posterior covariance matrices. Precision matrices are symmetric positive definite
+    I         = tf.eye(self.w_dim, batch_shape=[self.n_outputs], dtype=self.dtype)
+    w_Sigma   = tf.cholesky_solve(tf.cholesky(w_Lambda), I)
+
+    # Compute the posterior means
+    w_mu      = tf.matmul(w_Sigma, self.beta * self.Xty + tf.matmul(self.w_Lambda, self.w_mu))
+
+    update_op = self._tf_update_params(w_mu, w_Sigma, w_Lambda)
+
+    # Clear the accumulators only after the posterior is computed
+    with tf.control_dependencies([update_op]):
+      clear_op = self._clear_accumulators()
+    return tf.group(update_op, clear_op)
+
+
+  def resample_w(self, cholesky=False):
+    sample = tf.random_normal(shape=self.w_mu.shape, dtype=self.dtype)
+
+    # Compute A s.t. A A^T = w_Sigma for every model. Note that SVD and Cholesky give different A
+    if cholesky:
+      # Use cholesky
+      A = tf.cholesky(self.w_Sigma)
+    else:
+      # Use SVD
+      S, U, _ = tf.svd(self.w_Sigma)
+      A = U * tf.expand_dims(tf.sqrt(S), axis=-2)
+
+    w = self.w_mu + tf.matmul(A, sample)
+    return tf.assign(self.w, w, name="resample_w")
+
+
+  @property
+  def reset(self):
+    return self.reset_op
+
+
+  @property
+  def trainable_weights(self):
+    return self._trainable_weights or []
+
+
+  def _build_accumulators(self):
+    """Create the accumulator variables. They are local variables, so they are not saved in checkpoints
+    and are not copied to the target network. They are created only if the layer is trained from
+    accumulated data"""
+    if self.XtX is not None:
+      return
+
+    assert self.built
+
+    with tf.variable_scope(self._scope, auxiliary_name_scope=False):
+      self.XtX = tf.get_variable("XtX",
+                                 shape=[self.n_outputs, self.w_dim, self.w_dim],
+                                 dtype=self.dtype,
+                                 initializer=tf.zeros_initializer(),
+                                 trainable=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+      self.Xty = tf.get_variable("Xty",
+                                 shape=[self.n_outputs, self.w_dim, 1],
+                                 dtype=self.dtype,
+                                 initializer=tf.zeros_initializer(),
+                                 trainable=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+
+  def _clear_accumulators(self):
+    XtX_op = tf.assign(self.XtX, tf.zeros_like(self.XtX))
+    Xty_op = tf.assign(self.Xty, tf.zeros_like(self.Xty))
+    return tf.group(XtX_op, Xty_op)
+
+
+  def _mask_inputs(self, X, y, index):
+    """Split the data between the models. Every model sees only its own examples; the rest are zeroed
+    Returns:
+      X: tf.Tensor, `shape=[n_outputs, None, D]`
+      y: tf.Tensor, `shape=[n_outputs, None, 1]`
+    """
+    X     = self._cast_input(X)
+    y     = self._cast_input(y)
+
+    mask  = tf.one_hot(index, self.n_outputs, dtype=self.dtype)     # out shape: [None, n_outputs]
+    mask  = tf.expand_dims(tf.transpose(mask), axis=-1)            # out shape: [n_outputs, None, 1]
+    X     = mask * X                                                # out shape: [n_outputs, None, D]
+    y     = mask * tf.reshape(y, [-1, 1])                           # out shape: [n_outputs, None, 1]
+    return X, y
+
+
+  def _tf_update_params(self, w_mu, w_Sigma, w_Lambda):
+    """
+    Returns:
+      tf.Op which performs an update on all weight parameters
+    """
+    mu_op     = tf.assign(self.w_mu,      w_mu)
+    Sigma_op  = tf.assign(self.w_Sigma,   w_Sigma)
+    Lambda_op = tf.assign(self.w_Lambda,  w_Lambda)
+    return tf.group(mu_op, Sigma_op, Lambda_op)
+
+
+  def _cast_input(self, x):
+    if self.dtype == tf.float64 and x.dtype.base_dtype != tf.float64:
+      x = tf.cast(x, self.dtype)
+    return x
+
+
+  def _cast_output(self, x):
+    if x.dtype.base_dtype != tf.float32:
+      x = tf.cast(x, tf.float32)
+    return x
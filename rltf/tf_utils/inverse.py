@@ -39,9 +39,9 @@ def woodburry_inverse(A_inv, U, V):
   `(A + UV)^-1 = A^-1 - A^-1 U (I + V A^-1 U)^-1 V A^-1`. For details see:
   https://en.wikipedia.org/wiki/Woodbury_matrix_identity
   Args:
-    A_inv: tf.Tensor. The inverse of A, `shape=[N, N]`
-    U: tf.Tensor, `shape=[N, M]`
-    V: tf.Tensor. `shape=[M, N]`
+    A_inv: tf.Tensor. The inverse of A or batch. Last two dimensions should have shape [N, N]
+    U: tf.Tensor. (Batch of) matrices. Last two dimensions should have shape [N, M]
+    V: tf.Tensor. (Batch of) matrices. Last two dimensions should have shape [M, N]
   Returns: (A + UV)^-1 with the same shape and dtype as `A_inv`
   """
 
@@ -56,7 +56,7 @@ def woodburry_inverse(A_inv, U, V):
 
   A_inv_U = tf.matmul(A_inv_64, U_64)
   V_A_inv = tf.matmul(V_64, A_inv_64)
-  I       = tf.eye(tf.shape(V)[0], dtype=tf.float64)
+  I       = tf.eye(tf.shape(V)[-2], dtype=tf.float64)
   inverse = tf.matrix_inverse(I + tf.matmul(V_64, A_inv_U))
   inverse = tf.matmul(A_inv_U, inverse)
   inverse = tf.matmul(inverse, V_A_inv)
@@ -1,5 +1,6 @@
 import logging
 import tensorflow as tf
+import numpy as np
 
 
 logger = logging.getLogger(__name__)
@@ -53,6 +54,56 @@ def scope_vars(var_list, scope):
   return [v for v in var_list if scope in v.name]
 
 
+def restore_vars(sess, ckpt_path, var_list=None, stack_map=None):
+  """Restore variables from a checkpoint. Variables which are missing from the checkpoint, but
+  which were stored as several separate variables in older checkpoints, are restored by stacking
+  the old values along a new axis. Optimizer slots of such variables are handled as well.
+
+  Args:
+    sess: tf.Session. Currently open session
+    ckpt_path: str. Path to the checkpoint
+    var_list: list of `tf.Variable`s. Variables to restore. If None, all global variables
+    stack_map: dict of str-tuple pairs. Maps the name of a variable to a tuple `(old_names, axis)`,
+      where `old_names` is the list of names of the old variables whose values must be stacked
+      along `axis`. If None, a plain `tf.train.Saver` is used
+  """
+  if var_list is None:
+    var_list = tf.global_variables()
+
+  if not stack_map:
+    tf.train.Saver(var_list).restore(sess, ckpt_path)
+    return
+
+  reader      = tf.train.NewCheckpointReader(ckpt_path)
+  ckpt_vars   = reader.get_variable_to_shape_map()
+
+  saved_vars  = []
+  stacked     = {}
+  for v in var_list:
+    name = v.op.name
+    if name in ckpt_vars:
+      saved_vars.append(v)
+      continue
+    # Match the variable itself or one of its optimizer slots, e.g. "<name>/RMSProp"
+    for new_name, (old_names, axis) in stack_map.items():
+      if name == new_name or name.startswith(new_name + "/"):
+        suffix    = name[len(new_name):]
+        old_names = [old_name + suffix for old_name in old_names]
+        if all(old_name in ckpt_vars for old_name in old_names):
+          stacked[v] = (old_names, axis)
+        break
+    if v not in stacked:
+      # Let the Saver report the missing variable
+      saved_vars.append(v)
+
+  if saved_vars:
+    tf.train.Saver(saved_vars).restore(sess, ckpt_path)
+
+  for v, (old_names, axis) in stacked.items():
+    logger.info("Restoring %s from stacked %s", v.op.name, old_names)
+    v.load(np.stack([reader.get_tensor(old_name) for old_name in old_names], axis=axis), sess)
+
+
 def normalize(x, training, momentum=0.0):
   """Normalize a tensor along the batch dimension. Normalization is done using the statistics of the
   current batch (in training mode) or based on running mean and variance (in inference mode).
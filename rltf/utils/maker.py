@@ -4,12 +4,14 @@ import os
 import gym
 
 from rltf.envs        import MaxEpisodeLen
+from rltf.envs        import SubprocEnv
 from rltf.utils       import rltf_conf
 from rltf.utils       import rltf_log
 from rltf.utils       import seeding
 
 
-def get_env_maker(env_id, seed, wrap=None, max_ep_steps_train=None, max_ep_steps_eval=None, **wrap_kwargs):
+def get_env_maker(env_id, seed, wrap=None, max_ep_steps_train=None, max_ep_steps_eval=None,
+                  subproc=False, **wrap_kwargs):
   """Create an environment maker function
   Args:
     env_id: str or callable. If str, full name of a registered gym, roboschool or pybullet
@@ -18,7 +20,10 @@ def get_env_maker(env_id, seed, wrap=None, max_ep_steps_train=None, max_ep_steps
     wrap: function. Must take as arguments the environment and its mode and wrap it.
     max_ep_steps_train: int. A limit on the max steps in a training episode.
     max_ep_steps_eval: int. A limit on the max steps in an evaluation episode.
-    wrap_kwargs: dict. Keyword arguments that will be passed to the wrapper
+    subproc: bool. If True, every environment is created and run in its own worker process.
+      See `rltf.envs.SubprocEnv`
+    wrap_kwargs: dict. Keyword arguments that will be passed to the wrapper, e.g. `stack` and `fused`
+      for `rltf.envs.wrap_deepmind_atari`
   Returns:
     callable which takes the mode of an env and builds a new enviornment instance
   """
@@ -50,24 +55,36 @@ def get_env_maker(env_id, seed, wrap=None, max_ep_steps_train=None, max_ep_steps
   def make_env(mode):
     nonlocal env_seed
 
-    # Make the environment
-    env = make()
-
+    # Increment seed to avoid producing identical environments
     if env_seed >= 0:
-      # Increment seed to avoid producing identical environments
       env_seed += 1
-      env.seed(env_seed)
+    seed_i = env_seed
+
+    def make_base():
+      # Make the environment
+      env = make()
+
+      if seed_i >= 0:
+        env.seed(seed_i)
+
+      # NOTE: Wrapper for episode steps limit must be set before any other wrapper
+      if mode == 't' and max_ep_steps_train is not None:
+        env = MaxEpisodeLen(env, max_episode_steps=max_ep_steps_train)
+      elif mode == 'e' and max_ep_steps_eval is not None:
+        env = MaxEpisodeLen(env, max_episode_steps=max_ep_steps_eval)
+
+      return env
 
-    # NOTE: Wrapper for episode steps limit must be set before any other wrapper
-    if mode == 't' and max_ep_steps_train is not None:
-      env = MaxEpisodeLen(env, max_episode_steps=max_ep_steps_train)
-    elif mode == 'e' and max_ep_steps_eval is not None:
-      env = MaxEpisodeLen(env, max_episode_steps=max_ep_steps_eval)
+    def wrap_env(env):
+      if wrap is not None:
+        env = wrap(env, mode, **wrap_kwargs)
+      return env
 
-    if wrap is not None:
-      env = wrap(env, mode, **wrap_kwargs)
+    # The worker process builds the env with the seed that was assigned to it here
+    if subproc:
+      return SubprocEnv(make_base, wrap_env)
 
-    return env
+    return wrap_env(make_base())
 
   return make_env
 